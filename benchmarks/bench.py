@@ -0,0 +1,176 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+# ---------------------------------------------------------------------------
+# Offline benchmark suite: golden-value accuracy, point latency, grid throughput,
+# render time and peak memory. Results are written as JSON and compared against a
+# stored baseline recorded on the same machine.
+#
+#   python benchmarks/bench.py                     # run, compare, exit 1 on regression
+#   python benchmarks/bench.py --update-baseline   # record a new baseline
+# ---------------------------------------------------------------------------
+HERE = os.path.dirname(os.path.abspath(__file__))
+GOLDEN_PATH = os.path.join(HERE, 'golden.json')
+DEFAULT_BASELINE = os.path.join(HERE, 'baseline.json')
+DEFAULT_OUTPUT = os.path.join(HERE, 'results.json')
+GRID_RESOLUTIONS = (80, 200, 500)
+STABILITY_CLASSES = 'ABCDEF'
+AREA_TYPES = ('rural', 'urban')
+
+def timed(func, repeat, number):
+    # Median seconds per call over `repeat` runs of `number` calls.
+    runs = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(number):
+            func()
+        runs.append((time.perf_counter() - started) / number)
+    return statistics.median(runs)
+
+def peak_memory(func):
+    # Peak bytes allocated while func runs (NumPy buffers are traced too).
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def check_accuracy(golden, tolerance):
+    scenarios = golden['scenarios']
+    scalar_error = 0.0
+    array_error = 0.0
+    failures = []
+    for s, area, cls, x, y, z, expected in golden['concentration']:
+        params = dict(scenarios[s], stability_class=cls, area_type=area)
+        for kind, value in (
+            ('scalar', main.calculate_concentration(x, y, z, **params)[0]),
+            ('array', float(main.calculate_concentration_array(np.array([x]), y, z, **params)[0])),
+        ):
+            error = abs(value - expected) / abs(expected) if expected else abs(value)
+            if kind == 'scalar': scalar_error = max(scalar_error, error)
+            else: array_error = max(array_error, error)
+            if error > tolerance:
+                failures.append(f"{kind} C s={s} {area} {cls} x={x} y={y} z={z}: {value!r} != {expected!r}")
+    for cls, x_km, expected in golden['rural_sigma_z_params']:
+        value = main.get_rural_sigma_z_params_a_b(cls, x_km)
+        value = None if value is None else [value['a'], value['b']]
+        if value != expected:
+            failures.append(f"sigma-z params {cls} x_km={x_km}: {value} != {expected}")
+    return {
+        'cases': len(golden['concentration']) + len(golden['rural_sigma_z_params']),
+        'max_relative_error_scalar': scalar_error,
+        'max_relative_error_array': array_error,
+        'tolerance': tolerance,
+        'failures': failures,
+    }
+
+def run_benchmarks(golden, repeat):
+    base = golden['scenarios'][0]
+    point = {'x': 2000.0, 'y': 50.0, 'z': 1.5}
+    results = {}
+
+    def record(name, value, unit):
+        results[name] = {'value': value, 'unit': unit}
+
+    # Single point through the public scalar API, including scenario compilation.
+    for area in AREA_TYPES:
+        for cls in STABILITY_CLASSES:
+            params = dict(base, stability_class=cls, area_type=area)
+            def single_point():
+                main._compile_scenario.cache_clear()
+                main.calculate_concentration(point['x'], point['y'], point['z'], **params)
+            record(f"point.{area}.{cls}", timed(single_point, repeat, 200), 's')
+    record("sigma_z_params", timed(lambda: main.get_rural_sigma_z_params_a_b('D', 2.5), repeat, 2000), 's')
+
+    # Grid evaluation at several resolutions over the fixed plot extent.
+    scenario = main.compile_scenario(dict(base, stability_class='D', area_type='rural'))
+    for n in GRID_RESOLUTIONS:
+        X, Y = np.meshgrid(np.linspace(1, 10000, n), np.linspace(-2000, 2000, n))
+        seconds = timed(lambda: scenario.concentration(X, Y, point['z']), repeat, 1)
+        record(f"grid.{n}x{n}", seconds, 's')
+        record(f"grid.{n}x{n}.points_per_second", n * n / seconds, 'points/s')
+        record(f"grid.{n}x{n}.peak_memory", peak_memory(lambda: scenario.concentration(X, Y, point['z'])), 'bytes')
+
+    # Full plot generation (grid + render + encode) for both renderers.
+    renderer = main.PLOT_RENDERER
+    try:
+        for name in ('matplotlib', 'raster'):
+            main.PLOT_RENDERER = name
+            main.generate_plot_for_telegram(scenario, point)  # first render pays the imports
+            record(f"render.{name}", timed(lambda: main.generate_plot_for_telegram(scenario, point), repeat, 1), 's')
+            record(f"render.{name}.peak_memory",
+                   peak_memory(lambda: main.generate_plot_for_telegram(scenario, point)), 'bytes')
+    finally:
+        main.PLOT_RENDERER = renderer
+    return results
+
+def compare(results, baseline, max_slowdown):
+    # Lower is better for seconds and bytes; throughput figures are informational.
+    regressions = []
+    for name, current in results['metrics'].items():
+        previous = baseline.get('metrics', {}).get(name)
+        if previous is None or current['unit'] not in ('s', 'bytes') or previous['value'] <= 0: continue
+        ratio = current['value'] / previous['value']
+        if ratio > max_slowdown:
+            regressions.append(f"{name}: {previous['value']:.6g} -> {current['value']:.6g} {current['unit']} (x{ratio:.2f})")
+    return regressions
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the plume engine and plot rendering")
+    parser.add_argument('--output', default=DEFAULT_OUTPUT)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--max-slowdown', type=float, default=float(os.environ.get('BENCH_MAX_SLOWDOWN', 1.5)),
+                        help="fail when a timing or memory figure exceeds baseline x this factor")
+    parser.add_argument('--tolerance', type=float, default=1e-9, help="relative tolerance for golden values")
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--update-baseline', action='store_true')
+    args = parser.parse_args()
+
+    with open(GOLDEN_PATH, encoding='utf-8') as f:
+        golden = json.load(f)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+        'accuracy': check_accuracy(golden, args.tolerance),
+        'metrics': run_benchmarks(golden, args.repeat),
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, indent=2)
+
+    for name, metric in results['metrics'].items():
+        print(f"{name:40s} {metric['value']:14.6g} {metric['unit']}")
+    accuracy = results['accuracy']
+    print(f"accuracy: {accuracy['cases']} golden cases, max relative error "
+          f"{accuracy['max_relative_error_scalar']:.2e} (scalar) / {accuracy['max_relative_error_array']:.2e} (array)")
+    failed = bool(accuracy['failures'])
+    for failure in accuracy['failures'][:20]:
+        print("ACCURACY FAILURE:", failure)
+
+    if args.update_baseline:
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f"baseline written to {args.baseline}")
+    elif os.path.exists(args.baseline):
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(results, json.load(f), args.max_slowdown)
+        for regression in regressions:
+            print("REGRESSION:", regression)
+        failed = failed or bool(regressions)
+    else:
+        print(f"no baseline at {args.baseline}; run with --update-baseline to record one")
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main_cli())
@@ -1,15 +1,41 @@
+import asyncio
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import csv
+import functools
+import gzip
+import hashlib
+import http.server
+import itertools
+import json
 import logging
 import io
+import multiprocessing
 import os
+import pickle
+import struct
+import tempfile
+import threading
+import time
+import zlib
+from typing import NamedTuple, Optional
+
+_MODULE_LOAD_STARTED = time.perf_counter()
+
 import numpy as np
-import matplotlib.pyplot as plt
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove
+from telegram.error import BadRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     ContextTypes,
     ConversationHandler,
     MessageHandler,
+    PersistenceInput,
     filters,
 )
 
@@ -18,258 +44,1969 @@ logging.basicConfig(
     format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
 )
 logger = logging.getLogger(__name__)
+logger.info("Core imports took %.3f s", time.perf_counter() - _MODULE_LOAD_STARTED)
 
 # ---------------------------------------------------------------------------
 # Part 1: The Scientific Calculation Engine (MODIFIED TO RETURN A TRACE)
 # ---------------------------------------------------------------------------
+_PASQUILL_GIFFORD_C_D = {
+    'A': {'c': 24.1670, 'd': 2.5334}, 'B': {'c': 18.3330, 'd': 1.8096}, 'C': {'c': 12.5000, 'd': 1.0857},
+    'D': {'c': 8.3330, 'd': 0.72382}, 'E': {'c': 6.2500, 'd': 0.54287}, 'F': {'c': 4.1667, 'd': 0.36191},
+}
+
+def _just_above(x_km):
+    return float(np.nextafter(x_km, np.inf))
+
+# Rural sigma-z coefficients as (first x_km of the range, a, b) rows, sorted by distance.
+# A range extends until the next one starts, so distances that fall between two
+# textbook ranges (e.g. 0.155 km for class A) use the lower range's coefficients.
+_RURAL_SIGMA_Z_ROWS = {
+    'A': [(-np.inf, 122.800, 0.94470), (0.10, 158.080, 1.05420), (0.16, 170.220, 1.09320),
+          (0.21, 179.520, 1.12620), (0.26, 217.410, 1.26440), (0.31, 258.890, 1.40940),
+          (0.41, 346.750, 1.72830), (0.51, 453.850, 2.11660)],
+    'B': [(-np.inf, 90.673, 0.93198), (0.21, 98.483, 0.98332), (_just_above(0.40), 109.300, 1.09710)],
+    'C': [(-np.inf, 61.141, 0.91465)],
+    'D': [(-np.inf, 34.459, 0.86974), (0.31, 32.093, 0.81066), (1.01, 32.093, 0.64403),
+          (3.01, 33.504, 0.60486), (10.01, 36.650, 0.56589), (_just_above(30.00), 44.053, 0.51179)],
+    'E': [(-np.inf, 24.260, 0.83660), (0.10, 23.331, 0.81956), (0.31, 21.628, 0.75660),
+          (1.01, 21.628, 0.63077), (2.01, 22.534, 0.57154), (4.01, 24.703, 0.50527),
+          (10.01, 26.970, 0.46713), (20.01, 35.420, 0.37615), (_just_above(40.00), 47.618, 0.29592)],
+    'F': [(-np.inf, 15.209, 0.81558), (0.21, 14.457, 0.78407), (0.71, 13.953, 0.68465),
+          (1.01, 13.953, 0.63227), (2.01, 14.823, 0.54503), (3.01, 16.187, 0.46490),
+          (7.01, 17.836, 0.41507), (15.01, 22.651, 0.32681), (30.01, 27.074, 0.27436),
+          (_just_above(60.00), 34.219, 0.21716)],
+}
+_RURAL_SIGMA_Z_TABLES = {
+    stability_class: tuple(np.array(column) for column in zip(*rows))
+    for stability_class, rows in _RURAL_SIGMA_Z_ROWS.items()
+}
+# Class A coefficients are only defined up to 3.11 km; beyond that sigma-z is fixed at 5000 m.
+_RURAL_SIGMA_Z_MAX_KM = {'A': 3.11}
+
 def get_rural_pasquill_gifford_params_c_d(stability_class):
-    params = {'A':{'c':24.1670,'d':2.5334},'B':{'c':18.3330,'d':1.8096},'C':{'c':12.5000,'d':1.0857},'D':{'c':8.3330,'d':0.72382},'E':{'c':6.2500,'d':0.54287},'F':{'c':4.1667,'d':0.36191}}
-    return params.get(stability_class)
+    return _PASQUILL_GIFFORD_C_D.get(stability_class)
+
+def lookup_rural_sigma_z_params(stability_class, x_km):
+    # Vectorized binary search of the breakpoint table; returns (a, b) arrays shaped like x_km.
+    breakpoints, a, b = _RURAL_SIGMA_Z_TABLES[stability_class]
+    row = np.searchsorted(breakpoints, x_km, side='right') - 1
+    return a[row], b[row]
 
 def get_rural_sigma_z_params_a_b(stability_class, x_km):
-    if stability_class == 'A':
-        if x_km < 0.10: return {'a': 122.800, 'b': 0.94470}
-        if 0.10 <= x_km <= 0.15: return {'a': 158.080, 'b': 1.05420}
-        if 0.16 <= x_km <= 0.20: return {'a': 170.220, 'b': 1.09320}
-        if 0.21 <= x_km <= 0.25: return {'a': 179.520, 'b': 1.12620}
-        if 0.26 <= x_km <= 0.30: return {'a': 217.410, 'b': 1.26440}
-        if 0.31 <= x_km <= 0.40: return {'a': 258.890, 'b': 1.40940}
-        if 0.41 <= x_km <= 0.50: return {'a': 346.750, 'b': 1.72830}
-        if 0.51 <= x_km <= 3.11: return {'a': 453.850, 'b': 2.11660}
-        return None
-    elif stability_class == 'B':
-        if x_km < 0.20: return {'a': 90.673, 'b': 0.93198}
-        if 0.21 <= x_km <= 0.40: return {'a': 98.483, 'b': 0.98332}
-        return {'a': 109.300, 'b': 1.09710}
-    elif stability_class == 'C': return {'a': 61.141, 'b': 0.91465}
-    elif stability_class == 'D':
-        if x_km < 0.30: return {'a': 34.459, 'b': 0.86974}
-        if 0.31 <= x_km <= 1.00: return {'a': 32.093, 'b': 0.81066}
-        if 1.01 <= x_km <= 3.00: return {'a': 32.093, 'b': 0.64403}
-        if 3.01 <= x_km <= 10.00: return {'a': 33.504, 'b': 0.60486}
-        if 10.01 <= x_km <= 30.00: return {'a': 36.650, 'b': 0.56589}
-        return {'a': 44.053, 'b': 0.51179}
-    elif stability_class == 'E':
-        if x_km < 0.10: return {'a': 24.260, 'b': 0.83660}
-        if 0.10 <= x_km <= 0.30: return {'a': 23.331, 'b': 0.81956}
-        if 0.31 <= x_km <= 1.00: return {'a': 21.628, 'b': 0.75660}
-        if 1.01 <= x_km <= 2.00: return {'a': 21.628, 'b': 0.63077}
-        if 2.01 <= x_km <= 4.00: return {'a': 22.534, 'b': 0.57154}
-        if 4.01 <= x_km <= 10.00: return {'a': 24.703, 'b': 0.50527}
-        if 10.01 <= x_km <= 20.00: return {'a': 26.970, 'b': 0.46713}
-        if 20.01 <= x_km <= 40.00: return {'a': 35.420, 'b': 0.37615}
-        return {'a': 47.618, 'b': 0.29592}
-    elif stability_class == 'F':
-        if x_km < 0.20: return {'a': 15.209, 'b': 0.81558}
-        if 0.21 <= x_km <= 0.70: return {'a': 14.457, 'b': 0.78407}
-        if 0.71 <= x_km <= 1.00: return {'a': 13.953, 'b': 0.68465}
-        if 1.01 <= x_km <= 2.00: return {'a': 13.953, 'b': 0.63227}
-        if 2.01 <= x_km <= 3.00: return {'a': 14.823, 'b': 0.54503}
-        if 3.01 <= x_km <= 7.00: return {'a': 16.187, 'b': 0.46490}
-        if 7.01 <= x_km <= 15.00: return {'a': 17.836, 'b': 0.41507}
-        if 15.01 <= x_km <= 30.00: return {'a': 22.651, 'b': 0.32681}
-        if 30.01 <= x_km <= 60.00: return {'a': 27.074, 'b': 0.27436}
-        return {'a': 34.219, 'b': 0.21716}
-    return None
+    if stability_class not in _RURAL_SIGMA_Z_TABLES: return None
+    if x_km > _RURAL_SIGMA_Z_MAX_KM.get(stability_class, np.inf): return None
+    a, b = lookup_rural_sigma_z_params(stability_class, x_km)
+    return {'a': float(a), 'b': float(b)}
 
-def calculate_concentration(
+class PlumeTerms(NamedTuple):
+    # Intermediate quantities of one receptor evaluation, in the order of the
+    # step-by-step report. Coefficient tuples are (c, d) / (C_sy,) for sigma-y and
+    # (a, b) for sigma-z; sigma_z_coefficients is None past the class-A 3.11 km limit.
+    x: float
+    y: float
+    z: float
+    Q_emission: float
+    u_ref: float
+    z_ref: float
+    hs_stack_height: float
+    stability_class: str
+    area_type: str
+    T_half_life: float
+    p: float
+    us: float
+    sigma_y_coefficients: tuple
+    sigma_y: float
+    sigma_z_coefficients: Optional[tuple]
+    sigma_z: float
+    sigma_z_capped: bool
+    Fb: float
+    delta_T: float
+    delta_T_c: float
+    is_stable: bool
+    is_buoyancy_dominated: bool
+    delta_h: float
+    xf: float
+    h_prime_s: float
+    he: float
+    sigma_ye: float
+    sigma_ze: float
+    V: float
+    psi: float
+    D: float
+    C: float
+
+_P_EXPONENTS = {
+    'rural': {'A': 0.07, 'B': 0.07, 'C': 0.10, 'D': 0.15, 'E': 0.35, 'F': 0.55},
+    'urban': {'A': 0.15, 'B': 0.15, 'C': 0.20, 'D': 0.25, 'E': 0.30, 'F': 0.30}
+}
+_URBAN_SIGMA_Y_C = {'A': 0.32, 'B': 0.32, 'C': 0.22, 'D': 0.16, 'E': 0.11, 'F': 0.11}
+
+# The user_data keys that make up one scenario, in calculate_concentration's order.
+SCENARIO_PARAM_NAMES = (
+    'Q_emission', 'u_ref', 'z_ref', 'stability_class', 'area_type', 'Hm_boundary_layer',
+    'ds_stack_diameter', 'hs_stack_height', 'Ts_stack_temp', 'Ta_ambient_temp',
+    'vs_stack_velocity', 'T_half_life',
+)
+
+class PlumeScenario:
+    # Source and meteorology terms (Us, Fb, ΔTc, Δh, xf, h's) are computed once here;
+    # the receptor-dependent steps are methods that accept scalars or NumPy arrays.
+    __slots__ = (
+        'params', 'stability_class', 'area_type', 'Q_emission', 'u_ref', 'z_ref', 'hs_stack_height',
+        'Hm_boundary_layer', 'T_half_life', 'p', 'us', 'Fb', 'delta_T', 'delta_T_c', 'is_stable',
+        'is_buoyancy_dominated', 'delta_h', 'xf', 'h_prime_s', 'rise_coefficient', 'rise_exponent', 'psi',
+    )
+
+    def __init__(
+        self, Q_emission, u_ref, z_ref, stability_class, area_type, Hm_boundary_layer,
+        ds_stack_diameter, hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+        T_half_life
+    ):
+        g = 9.8
+        self.params = {name: value for name, value in zip(SCENARIO_PARAM_NAMES, (
+            Q_emission, u_ref, z_ref, stability_class, area_type, Hm_boundary_layer,
+            ds_stack_diameter, hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+            T_half_life))}
+        self.stability_class = stability_class
+        self.area_type = area_type
+        self.Q_emission = Q_emission
+        self.u_ref = u_ref
+        self.z_ref = z_ref
+        self.hs_stack_height = hs_stack_height
+        self.Hm_boundary_layer = Hm_boundary_layer
+        self.T_half_life = T_half_life
+
+        # Step 2: Calculate wind speed at stack height (Us)
+        self.p = _P_EXPONENTS[area_type][stability_class]
+        us = u_ref * (hs_stack_height / z_ref) ** self.p
+        if us == 0: us = 1e-6
+        self.us = us
+
+        # Step 7 (receptor-independent part): buoyancy, critical temperature and final rise
+        delta_T = Ts_stack_temp - Ta_ambient_temp
+        Fb = g * vs_stack_velocity * (ds_stack_diameter**2) * (delta_T / (4 * Ts_stack_temp))
+        is_stable = stability_class in ['E', 'F']
+        if is_stable:
+            s = 0.035 if stability_class == 'F' else 0.020
+            delta_T_c = 0.01958 * Ts_stack_temp * vs_stack_velocity * np.sqrt(s)
+        else:
+            if Fb >= 55: delta_T_c = 0.00575 * Ts_stack_temp * (vs_stack_velocity**(2/3)) / (ds_stack_diameter**(1/3))
+            else: delta_T_c = 0.0297 * Ts_stack_temp * (vs_stack_velocity**(1/3)) / (ds_stack_diameter**(2/3))
+        is_buoyancy_dominated = delta_T > delta_T_c
+        if is_stable:
+            if is_buoyancy_dominated: delta_h = 2.6 * (Fb / (us * s))**(1/3)
+            else: delta_h = 3 * ds_stack_diameter * vs_stack_velocity / us
+            xf = 2.075 * us / np.sqrt(s)
+        else:
+            if is_buoyancy_dominated:
+                if Fb >= 55:
+                    delta_h = 38.71 * (Fb**0.6) / us; xf = 119 * (Fb**0.4)
+                else:
+                    delta_h = 21.25 * (Fb**0.75) / us; xf = 49 * (Fb**(5/8))
+            else:
+                delta_h = 3 * ds_stack_diameter * vs_stack_velocity / us
+                if Fb >= 55: xf = 119 * (Fb**0.4)
+                else: xf = 49 * (Fb**(5/8))
+        if vs_stack_velocity < 1.5 * us: h_prime_s = hs_stack_height + 2 * ds_stack_diameter * ((vs_stack_velocity / us) - 1.5)
+        else: h_prime_s = hs_stack_height
+
+        # Gradual rise before xf is written as h's + rise_coefficient * x**rise_exponent
+        if is_buoyancy_dominated:
+            rise_coefficient = 1.6 * (Fb / us**3)**(1/3); rise_exponent = 2/3
+        elif vs_stack_velocity == 0:
+            # No exit momentum: Fm = 0 and beta_j -> inf, so there is no gradual rise
+            rise_coefficient = 0.0; rise_exponent = 2/3 if is_stable else 1/3
+        else:
+            Fm = (vs_stack_velocity**2) * (ds_stack_diameter**2) * (Ta_ambient_temp / (4 * Ts_stack_temp))
+            beta_j = (1/3) + (us / vs_stack_velocity)
+            if is_stable:
+                rise_coefficient = 1.6 * (Fm / (beta_j**2 * us**2))**(1/3); rise_exponent = 2/3
+            else:
+                rise_coefficient = ((3 * Fm) / (beta_j**2 * us**2))**(1/3); rise_exponent = 1/3
+
+        self.Fb = Fb
+        self.delta_T = delta_T
+        self.delta_T_c = delta_T_c
+        self.is_stable = is_stable
+        self.is_buoyancy_dominated = is_buoyancy_dominated
+        self.delta_h = delta_h
+        self.xf = xf
+        self.h_prime_s = h_prime_s
+        self.rise_coefficient = rise_coefficient
+        self.rise_exponent = rise_exponent
+        # Step 10 (receptor-independent part): decay rate
+        self.psi = 0.693 / T_half_life if T_half_life > 0 else 0.0
+
+    # Steps 3-6: sigma-y and sigma-z depend only on x, the stability class and the area type
+    def dispersion_coefficients(self, x):
+        x_km = x / 1000.0
+        if self.area_type == 'rural':
+            cd = _PASQUILL_GIFFORD_C_D[self.stability_class]
+            theta = 0.017453293 * (cd['c'] - cd['d'] * np.log(x_km))
+            sigma_y = 465.11628 * x_km * np.tan(theta)
+            a, b = lookup_rural_sigma_z_params(self.stability_class, x_km)
+            sigma_z = a * (x_km ** b)
+            if self.stability_class == 'A':
+                sigma_z = np.where(x_km > 3.11, 5000.0, sigma_z)
+            if self.stability_class in ['A', 'B', 'C']:
+                sigma_z = np.minimum(sigma_z, 5000.0)
+        else: # urban
+            sigma_y = _URBAN_SIGMA_Y_C[self.stability_class] * x * (1.0 + 0.0004 * x) ** -0.5
+            if self.stability_class in ['A', 'B']: sigma_z = 0.24 * x * (1.0 + 0.001 * x) ** 0.5
+            elif self.stability_class == 'C': sigma_z = 0.20 * x
+            elif self.stability_class == 'D': sigma_z = 0.14 * x * (1.0 + 0.0003 * x) ** -0.5
+            else: sigma_z = 0.08 * x * (1.0 + 0.0015 * x) ** -0.5
+        return sigma_y, sigma_z
+
+    # Step 7: final rise at and beyond xf, gradual rise before it
+    def effective_height(self, x):
+        return np.where(x >= self.xf, self.h_prime_s + self.delta_h,
+                        self.h_prime_s + self.rise_coefficient * x ** self.rise_exponent)
+
+    # Step 9: effective sigmas include the plume-rise induced spread
+    def effective_sigmas(self, sigma_y, sigma_z):
+        sigma_ye = np.sqrt(sigma_y**2 + (self.delta_h / 3.5)**2)
+        sigma_ze = np.sqrt(sigma_z**2 + (self.delta_h / 3.5)**2)
+        return np.where(sigma_ye == 0, 1e-6, sigma_ye), np.where(sigma_ze == 0, 1e-6, sigma_ze)
+
+    # Step 8: vertical term with ground and mixing-layer reflections
+    def vertical_term(self, z, he, sigma_ze):
+        Hm = self.Hm_boundary_layer
+        V = np.exp(-0.5 * ((z - he) / sigma_ze)**2) + np.exp(-0.5 * ((z + he) / sigma_ze)**2)
+        for i in range(1, 6):
+            H1 = z - (2 * i * Hm - he); H2 = z + (2 * i * Hm - he)
+            H3 = z - (2 * i * Hm + he); H4 = z + (2 * i * Hm + he)
+            V = V + (np.exp(-0.5 * (H1 / sigma_ze)**2) + np.exp(-0.5 * (H2 / sigma_ze)**2) +
+                     np.exp(-0.5 * (H3 / sigma_ze)**2) + np.exp(-0.5 * (H4 / sigma_ze)**2))
+        return V
+
+    # Step 10: first-order decay during travel time x / Us
+    def decay_term(self, x):
+        return np.exp(-self.psi * x / self.us)
+
+    @staticmethod
+    def lateral_term(y, sigma_ye):
+        return np.exp(-0.5 * (y / sigma_ye)**2)
+
+    # Final Step: combine the terms
+    def combine(self, V, D, lateral_term, sigma_ye, sigma_ze):
+        K = 1e6
+        denominator = 2 * np.pi * self.us * sigma_ye * sigma_ze
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(denominator == 0, np.inf, (self.Q_emission * K * V * D / denominator) * lateral_term)
+
+    def concentration(self, x_receptor, y_receptor, z_receptor):
+        x, y, z = np.broadcast_arrays(
+            np.asarray(x_receptor, dtype=float), np.asarray(y_receptor, dtype=float),
+            np.asarray(z_receptor, dtype=float)
+        )
+        valid = x > 0
+        x = np.where(valid, x, 1.0)
+        sigma_y, sigma_z = self.dispersion_coefficients(x)
+        sigma_ye, sigma_ze = self.effective_sigmas(sigma_y, sigma_z)
+        he = self.effective_height(x)
+        C = self.combine(self.vertical_term(z, he, sigma_ze), self.decay_term(x),
+                         self.lateral_term(y, sigma_ye), sigma_ye, sigma_ze)
+        return np.where(valid, C, 0.0)
+
+    def sigma_terms(self, x_receptor):
+        # Steps 3-6 for one receptor, with the table coefficients used for the trace.
+        x_km = x_receptor / 1000.0
+        sigma_y, sigma_z = (float(v) for v in self.dispersion_coefficients(x_receptor))
+        if self.area_type == 'rural':
+            cd = _PASQUILL_GIFFORD_C_D[self.stability_class]
+            sigma_y_coefficients = (cd['c'], cd['d'])
+            if self.stability_class == 'A' and x_km > 3.11:
+                sigma_z_coefficients = None
+                sigma_z_capped = False
+            else:
+                a, b = lookup_rural_sigma_z_params(self.stability_class, x_km)
+                sigma_z_coefficients = (float(a), float(b))
+                sigma_z_capped = self.stability_class in ['A', 'B', 'C'] and a * (x_km ** b) > 5000
+        else:
+            sigma_y_coefficients = (_URBAN_SIGMA_Y_C[self.stability_class],)
+            sigma_z_coefficients = None
+            sigma_z_capped = False
+        return sigma_y, sigma_z, sigma_y_coefficients, sigma_z_coefficients, sigma_z_capped
+
+    def terms(self, x_receptor, y_receptor, z_receptor, stages=None):
+        # Single receptor with every intermediate value; None when x <= 0.
+        # `stages` holds {name: (inputs, outputs)} from an earlier call and is updated in
+        # place, so a stage whose inputs are unchanged is reused instead of recomputed.
+        if x_receptor <= 0: return None
+        stage = functools.partial(_reuse_stage, {} if stages is None else stages)
+        sigma_y, sigma_z, sigma_y_coefficients, sigma_z_coefficients, sigma_z_capped = stage(
+            'sigmas', (x_receptor, self.stability_class, self.area_type), lambda: self.sigma_terms(x_receptor))
+        sigma_ye, sigma_ze = stage(
+            'effective_sigmas', (sigma_y, sigma_z, self.delta_h),
+            lambda: tuple(float(v) for v in self.effective_sigmas(sigma_y, sigma_z)))
+        he = stage(
+            'effective_height',
+            (x_receptor, self.h_prime_s, self.delta_h, self.xf, self.rise_coefficient, self.rise_exponent),
+            lambda: float(self.effective_height(x_receptor)))
+        lateral = stage('lateral', (y_receptor, sigma_ye), lambda: float(self.lateral_term(y_receptor, sigma_ye)))
+        V = stage('vertical', (z_receptor, he, sigma_ze, self.Hm_boundary_layer),
+                  lambda: float(self.vertical_term(z_receptor, he, sigma_ze)))
+        D = stage('decay', (x_receptor, self.psi, self.us), lambda: float(self.decay_term(x_receptor)))
+        C = stage('combine', (V, D, lateral, sigma_ye, sigma_ze, self.us, self.Q_emission),
+                  lambda: float(self.combine(V, D, lateral, sigma_ye, sigma_ze)))
+        return PlumeTerms(
+            x=x_receptor, y=y_receptor, z=z_receptor, Q_emission=self.Q_emission, u_ref=self.u_ref,
+            z_ref=self.z_ref, hs_stack_height=self.hs_stack_height, stability_class=self.stability_class,
+            area_type=self.area_type, T_half_life=self.T_half_life, p=self.p, us=self.us,
+            sigma_y_coefficients=sigma_y_coefficients, sigma_y=sigma_y,
+            sigma_z_coefficients=sigma_z_coefficients, sigma_z=sigma_z, sigma_z_capped=sigma_z_capped,
+            Fb=self.Fb, delta_T=self.delta_T, delta_T_c=self.delta_T_c, is_stable=self.is_stable,
+            is_buoyancy_dominated=self.is_buoyancy_dominated, delta_h=self.delta_h, xf=self.xf,
+            h_prime_s=self.h_prime_s, he=he, sigma_ye=sigma_ye, sigma_ze=sigma_ze, V=V, psi=self.psi,
+            D=D, C=C,
+        )
+
+def _reuse_stage(stages, name, inputs, compute):
+    cached = stages.get(name)
+    if cached is not None and cached[0] == inputs: return cached[1]
+    outputs = compute()
+    stages[name] = (inputs, outputs)
+    return outputs
+
+@functools.lru_cache(maxsize=256)
+def _compile_scenario(values):
+    return PlumeScenario(*values)
+
+def compile_scenario(params):
+    # Accepts a PlumeScenario or a dict with the SCENARIO_PARAM_NAMES keys (extra keys are
+    # ignored); identical parameter sets share one cached PlumeScenario per process.
+    if isinstance(params, PlumeScenario): return params
+    return _compile_scenario(tuple(params[name] for name in SCENARIO_PARAM_NAMES))
+
+def calculate_concentration_terms(
     x_receptor, y_receptor, z_receptor, Q_emission, u_ref, z_ref,
     stability_class, area_type, Hm_boundary_layer, ds_stack_diameter,
     hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
     T_half_life
 ):
-    trace_log = ""
-    g = 9.8
-    if x_receptor <= 0: return 0.0, "فاصله x باید مثبت باشد."
-
-    # Step 2: Calculate wind speed at stack height (Us)
-    p_exponent_map = {
-        'rural': {'A': 0.07, 'B': 0.07, 'C': 0.10, 'D': 0.15, 'E': 0.35, 'F': 0.55},
-        'urban': {'A': 0.15, 'B': 0.15, 'C': 0.20, 'D': 0.25, 'E': 0.30, 'F': 0.30}
-    }
-    p = p_exponent_map[area_type][stability_class]
-    us = u_ref * (hs_stack_height / z_ref) ** p
-    if us == 0: us = 1e-6
-    trace_log += "--- ۱. محاسبه سرعت باد در ارتفاع دودکش (Us) ---\n"
-    trace_log += f"با توجه به کلاس پایداری '{stability_class}' و نوع منطقه '{area_type}'، ضریب توان p={p:.2f} است.\n"
-    trace_log += f"Us = U_ref * (hs / z_ref)^p\n"
-    trace_log += f"Us = {u_ref} * ({hs_stack_height} / {z_ref})^{p:.2f} = {us:.2f} m/s\n\n"
-
-    # Steps 3 & 4: Conditionally calculate sigma-y
-    x_km = x_receptor / 1000.0
-    trace_log += f"--- ۲. محاسبه ضریب پراکندگی افقی (σy) برای x={x_receptor} متر ---\n"
-    if area_type == 'rural':
-        params = get_rural_pasquill_gifford_params_c_d(stability_class)
-        c, d = params['c'], params['d']
-        theta = 0.017453293 * (c - d * np.log(x_km))
-        sigma_y = 465.11628 * x_km * np.tan(theta)
-        trace_log += f"منطقه حومه‌ای (rural) انتخاب شد. ضرایب: c={c}, d={d}\n"
-        trace_log += f"σy = 465.11628 * x_km * tan(0.01745 * [c - d*ln(x_km)]) = {sigma_y:.2f} متر\n\n"
+    # Returns a PlumeTerms record, or None when the receptor is not downwind (x <= 0).
+    scenario = _compile_scenario((
+        Q_emission, u_ref, z_ref, stability_class, area_type, Hm_boundary_layer,
+        ds_stack_diameter, hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+        T_half_life
+    ))
+    return scenario.terms(x_receptor, y_receptor, z_receptor)
+
+def rerun_point_terms(params, point, stages=None):
+    # Re-evaluates one receptor reusing the stage cache of the previous run. Returns the
+    # PlumeTerms, the updated cache and the names of the stages that were recomputed.
+    stages = dict(stages or {})
+    previous = dict(stages)
+    with stage_timer('engine_point'):
+        terms = compile_scenario(params).terms(point['x'], point['y'], point['z'], stages)
+    recomputed = [name for name, entry in stages.items() if previous.get(name) is not entry]
+    return terms, stages, recomputed
+
+def format_trace_report(terms):
+    # Renders the Persian step-by-step report; only called when a reply needs it.
+    if terms is None: return "فاصله x باید مثبت باشد."
+    t = terms
+    trace_log = []
+    trace_log.append("--- ۱. محاسبه سرعت باد در ارتفاع دودکش (Us) ---\n")
+    trace_log.append(f"با توجه به کلاس پایداری '{t.stability_class}' و نوع منطقه '{t.area_type}'، ضریب توان p={t.p:.2f} است.\n")
+    trace_log.append(f"Us = U_ref * (hs / z_ref)^p\n")
+    trace_log.append(f"Us = {t.u_ref} * ({t.hs_stack_height} / {t.z_ref})^{t.p:.2f} = {t.us:.2f} m/s\n\n")
+
+    trace_log.append(f"--- ۲. محاسبه ضریب پراکندگی افقی (σy) برای x={t.x} متر ---\n")
+    if t.area_type == 'rural':
+        c, d = t.sigma_y_coefficients
+        trace_log.append(f"منطقه حومه‌ای (rural) انتخاب شد. ضرایب: c={c}, d={d}\n")
+        trace_log.append(f"σy = 465.11628 * x_km * tan(0.01745 * [c - d*ln(x_km)]) = {t.sigma_y:.2f} متر\n\n")
     else: # urban
-        factor = (1.0 + 0.0004 * x_receptor) ** -0.5
-        if stability_class in ['A', 'B']: C_sy = 0.32
-        elif stability_class == 'C': C_sy = 0.22
-        elif stability_class == 'D': C_sy = 0.16
-        else: C_sy = 0.11
-        sigma_y = C_sy * x_receptor * factor
-        trace_log += f"منطقه شهری (urban) انتخاب شد. ضریب: C_sy={C_sy}\n"
-        trace_log += f"σy = {C_sy} * x * (1 + 0.0004*x)^-0.5 = {sigma_y:.2f} متر\n\n"
-
-    # Steps 5 & 6: Conditionally calculate sigma-z
-    trace_log += f"--- ۳. محاسبه ضریب پراکندگی عمودی (σz) برای x={x_receptor} متر ---\n"
-    if area_type == 'rural':
-        if stability_class == 'A' and x_km > 3.11:
-            sigma_z = 5000.0
-            trace_log += f"منطقه حومه‌ای (rural) و کلاس A با x > 3.11km -> σz = 5000 متر\n\n"
+        C_sy, = t.sigma_y_coefficients
+        trace_log.append(f"منطقه شهری (urban) انتخاب شد. ضریب: C_sy={C_sy}\n")
+        trace_log.append(f"σy = {C_sy} * x * (1 + 0.0004*x)^-0.5 = {t.sigma_y:.2f} متر\n\n")
+
+    trace_log.append(f"--- ۳. محاسبه ضریب پراکندگی عمودی (σz) برای x={t.x} متر ---\n")
+    if t.area_type == 'rural':
+        if t.sigma_z_coefficients is None:
+            trace_log.append(f"منطقه حومه‌ای (rural) و کلاس A با x > 3.11km -> σz = 5000 متر\n\n")
         else:
-            params = get_rural_sigma_z_params_a_b(stability_class, x_km)
-            a, b = params['a'], params['b']
-            sigma_z = a * (x_km ** b)
-            trace_log += f"منطقه حومه‌ای (rural) انتخاب شد. ضرایب: a={a}, b={b}\n"
-            trace_log += f"σz = a * (x_km)^b = {sigma_z:.2f} متر\n"
-        if stability_class in ['A', 'B', 'C'] and sigma_z > 5000:
-            sigma_z = 5000.0
-            trace_log += f"مقدار σz برای کلاس‌های A,B,C به 5000 متر محدود شد.\n\n"
+            a, b = t.sigma_z_coefficients
+            trace_log.append(f"منطقه حومه‌ای (rural) انتخاب شد. ضرایب: a={a}, b={b}\n")
+            trace_log.append(f"σz = a * (x_km)^b = {a * ((t.x / 1000.0) ** b):.2f} متر\n")
+        if t.sigma_z_capped:
+            trace_log.append(f"مقدار σz برای کلاس‌های A,B,C به 5000 متر محدود شد.\n\n")
         else:
-            trace_log += "\n"
+            trace_log.append("\n")
     else: # urban
-        if stability_class in ['A', 'B']: sigma_z = 0.24 * x_receptor * (1.0 + 0.001 * x_receptor) ** 0.5
-        elif stability_class == 'C': sigma_z = 0.20 * x_receptor
-        elif stability_class == 'D': sigma_z = 0.14 * x_receptor * (1.0 + 0.0003 * x_receptor) ** -0.5
-        else: sigma_z = 0.08 * x_receptor * (1.0 + 0.0015 * x_receptor) ** -0.5
-        trace_log += f"منطقه شهری (urban) انتخاب شد.\n"
-        trace_log += f"مقدار محاسبه شده: σz = {sigma_z:.2f} متر\n\n"
-
-    # Step 7: Calculate effective stack height (he)
-    trace_log += f"--- ۴. محاسبه ارتفاع موثر دودکش (he) ---\n"
-    delta_T = Ts_stack_temp - Ta_ambient_temp
-    Fb = g * vs_stack_velocity * (ds_stack_diameter**2) * (delta_T / (4 * Ts_stack_temp))
-    trace_log += f"گام ۴.۱: محاسبه پارامتر شناوری Fb = {Fb:.2f} m⁴/s³\n"
-    is_stable = stability_class in ['E', 'F']
-    stability_type = "پایدار" if is_stable else "ناپایدار"
-    trace_log += f"گام ۴.۲: شرایط جوی '{stability_type}' تشخیص داده شد.\n"
-    if is_stable:
-        s = 0.035 if stability_class == 'F' else 0.020
-        delta_T_c = 0.01958 * Ts_stack_temp * vs_stack_velocity * np.sqrt(s)
+        trace_log.append(f"منطقه شهری (urban) انتخاب شد.\n")
+        trace_log.append(f"مقدار محاسبه شده: σz = {t.sigma_z:.2f} متر\n\n")
+
+    trace_log.append(f"--- ۴. محاسبه ارتفاع موثر دودکش (he) ---\n")
+    trace_log.append(f"گام ۴.۱: محاسبه پارامتر شناوری Fb = {t.Fb:.2f} m⁴/s³\n")
+    stability_type = "پایدار" if t.is_stable else "ناپایدار"
+    trace_log.append(f"گام ۴.۲: شرایط جوی '{stability_type}' تشخیص داده شد.\n")
+    trace_log.append(f"گام ۴.۳: محاسبه دمای بحرانی ΔTc = {t.delta_T_c:.4f} K\n")
+    dom_phase = "شناوری غالب" if t.is_buoyancy_dominated else "تکانه غالب"
+    trace_log.append(f"گام ۴.۴: فاز '{dom_phase}' تشخیص داده شد (چون ΔT={t.delta_T:.2f}K در مقایسه با ΔTc={t.delta_T_c:.4f}K)\n")
+    trace_log.append(f"گام ۴.۵: محاسبه خیز نهایی توده Δh = {t.delta_h:.2f} متر و فاصله آن xf = {t.xf:.2f} متر\n")
+    trace_log.append(f"گام ۴.۶: محاسبه ارتفاع اصلاح شده دودکش (با Downwash) h's = {t.h_prime_s:.2f} متر\n")
+    if t.x >= t.xf:
+        trace_log.append(f"گام ۴.۷: چون x >= xf، خیز نهایی استفاده شد. he = h's + Δh = {t.he:.2f} متر\n\n")
     else:
-        if Fb >= 55: delta_T_c = 0.00575 * Ts_stack_temp * (vs_stack_velocity**(2/3)) / (ds_stack_diameter**(1/3))
-        else: delta_T_c = 0.0297 * Ts_stack_temp * (vs_stack_velocity**(1/3)) / (ds_stack_diameter**(2/3))
-    trace_log += f"گام ۴.۳: محاسبه دمای بحرانی ΔTc = {delta_T_c:.4f} K\n"
-    is_buoyancy_dominated = delta_T > delta_T_c
-    dom_phase = "شناوری غالب" if is_buoyancy_dominated else "تکانه غالب"
-    trace_log += f"گام ۴.۴: فاز '{dom_phase}' تشخیص داده شد (چون ΔT={delta_T:.2f}K در مقایسه با ΔTc={delta_T_c:.4f}K)\n"
-    if is_stable:
-        s = 0.035 if stability_class == 'F' else 0.020
-        if is_buoyancy_dominated: delta_h = 2.6 * (Fb / (us * s))**(1/3)
-        else: delta_h = 3 * ds_stack_diameter * vs_stack_velocity / us
-        xf = 2.075 * us / np.sqrt(s)
+        trace_log.append(f"گام ۴.۷: چون x < xf، از فرمول خیز تدریجی استفاده شد. he = {t.he:.2f} متر\n\n")
+
+    trace_log.append(f"--- ۵. محاسبه ضرایب پراکندگی موثر ---\n")
+    trace_log.append(f"σye = (σy² + (Δh/3.5)²)^0.5 = {t.sigma_ye:.2f} متر\n")
+    trace_log.append(f"σze = (σz² + (Δh/3.5)²)^0.5 = {t.sigma_ze:.2f} متر\n\n")
+
+    trace_log.append(f"--- ۶. محاسبه جمله قائم (V) ---\n")
+    trace_log.append(f"با در نظر گرفتن انعکاس از زمین و لایه مرزی، V = {t.V:.4f}\n\n")
+
+    trace_log.append(f"--- ۷. محاسبه جمله زوال (D) ---\n")
+    if t.T_half_life > 0:
+        trace_log.append(f"با نیمه عمر {t.T_half_life} ثانیه، ضریب زوال ψ = {t.psi:.4e}\n")
+        trace_log.append(f"مقدار D = exp(-ψ * x / Us) = {t.D:.4f}\n\n")
     else:
-        if is_buoyancy_dominated:
-            if Fb >= 55:
-                delta_h = 38.71 * (Fb**0.6) / us; xf = 119 * (Fb**0.4)
-            else:
-                delta_h = 21.25 * (Fb**0.75) / us; xf = 49 * (Fb**(5/8))
-        else:
-            delta_h = 3 * ds_stack_diameter * vs_stack_velocity / us
-            if Fb >= 55: xf = 119 * (Fb**0.4)
-            else: xf = 49 * (Fb**(5/8))
-    trace_log += f"گام ۴.۵: محاسبه خیز نهایی توده Δh = {delta_h:.2f} متر و فاصله آن xf = {xf:.2f} متر\n"
-    if vs_stack_velocity < 1.5 * us: h_prime_s = hs_stack_height + 2 * ds_stack_diameter * ((vs_stack_velocity / us) - 1.5)
-    else: h_prime_s = hs_stack_height
-    trace_log += f"گام ۴.۶: محاسبه ارتفاع اصلاح شده دودکش (با Downwash) h's = {h_prime_s:.2f} متر\n"
-    if x_receptor >= xf:
-        he = h_prime_s + delta_h
-        trace_log += f"گام ۴.۷: چون x >= xf، خیز نهایی استفاده شد. he = h's + Δh = {he:.2f} متر\n\n"
+        trace_log.append(f"آلاینده پایدار فرض شد (نیمه عمر=0)، D = 1.0\n\n")
+
+    trace_log.append(f"--- ۸. محاسبه غلظت نهایی (C) ---\n")
+    if np.isinf(t.C): return "".join(trace_log)
+    trace_log.append(f"C = (Q*K*V*D) / (2*π*Us*σye*σze) * exp[-0.5*(y/σye)²]\n")
+    trace_log.append(f"C = ({t.Q_emission} * {1e6:.0f} * {t.V:.2f} * {t.D:.2f}) / (2*π*{t.us:.2f}*{t.sigma_ye:.2f}*{t.sigma_ze:.2f}) * exp[-0.5*({t.y}/{t.sigma_ye:.2f})²]\n")
+    return "".join(trace_log)
+
+def calculate_concentration(
+    x_receptor, y_receptor, z_receptor, Q_emission, u_ref, z_ref,
+    stability_class, area_type, Hm_boundary_layer, ds_stack_diameter,
+    hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+    T_half_life
+):
+    terms = calculate_concentration_terms(
+        x_receptor, y_receptor, z_receptor, Q_emission, u_ref, z_ref,
+        stability_class, area_type, Hm_boundary_layer, ds_stack_diameter,
+        hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+        T_half_life
+    )
+    C = 0.0 if terms is None else terms.C
+    return C, format_trace_report(terms)
+
+def calculate_concentration_array(
+    x_receptor, y_receptor, z_receptor, Q_emission, u_ref, z_ref,
+    stability_class, area_type, Hm_boundary_layer, ds_stack_diameter,
+    hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+    T_half_life
+):
+    # Array-native twin of calculate_concentration: receptors are broadcast NumPy
+    # arrays and the result is a concentration array of the broadcast shape.
+    scenario = _compile_scenario((
+        Q_emission, u_ref, z_ref, stability_class, area_type, Hm_boundary_layer,
+        ds_stack_diameter, hs_stack_height, Ts_stack_temp, Ta_ambient_temp, vs_stack_velocity,
+        T_half_life
+    ))
+    return scenario.concentration(x_receptor, y_receptor, z_receptor)
+
+# matplotlib is imported on the first render, not at module load, to keep worker
+# restarts fast; the Agg backend is forced because the bot never opens a window.
+PLOT_PREWARM = os.environ.get("PLOT_PREWARM", "1") == "1"
+_PREWARM_PARAMS = {
+    'Q_emission': 100.0, 'u_ref': 4.0, 'z_ref': 10.0, 'stability_class': 'D', 'area_type': 'rural',
+    'Hm_boundary_layer': 800.0, 'ds_stack_diameter': 2.0, 'hs_stack_height': 50.0,
+    'Ts_stack_temp': 420.0, 'Ta_ambient_temp': 290.0, 'vs_stack_velocity': 12.0, 'T_half_life': 0.0,
+}
+_figure_class = None
+_first_render_done = False
+_plotting_lock = threading.Lock()
+
+def load_plotting():
+    global _figure_class
+    with _plotting_lock:
+        if _figure_class is None:
+            started = time.perf_counter()
+            import matplotlib
+            matplotlib.use('Agg')
+            from matplotlib.figure import Figure
+            _figure_class = Figure
+            logger.info("Imported matplotlib (Agg backend) in %.3f s", time.perf_counter() - started)
+    return _figure_class
+
+def prewarm_renderer():
+    # Renders a throwaway plot so the font cache and Agg setup are paid before the first user.
+    generate_plot_for_telegram(_PREWARM_PARAMS, {'x': 1000.0, 'y': 0.0, 'z': 0.0})
+
+def _concentration_breakpoints(scenario):
+    # Distances (m) where the concentration may jump: the gradual/final rise switch at xf
+    # and the starts of the rural sigma-z coefficient ranges. One row per stacked scenario.
+    xf = np.reshape(scenario.xf, (-1, 1))
+    breaks = []
+    if scenario.area_type == 'rural':
+        table_starts = _RURAL_SIGMA_Z_TABLES[scenario.stability_class][0]
+        breaks.extend(1000.0 * table_starts[np.isfinite(table_starts)])
+        if scenario.stability_class == 'A':
+            breaks.append(_just_above(3.11) * 1000.0)
+    return np.hstack([xf, np.broadcast_to(np.array(breaks, dtype=float), (xf.shape[0], len(breaks)))])
+
+def find_max_concentrations(scenario, z_receptor=0.0, y_receptor=0.0, x_min=1.0, x_max=100000.0,
+                            samples=400, refine_samples=33, refine_steps=6):
+    # Batched form of find_max_concentration for a (possibly stacked) PlumeScenario;
+    # returns (x at the maximum, maximum concentration) arrays with one entry per scenario.
+    breaks = _concentration_breakpoints(scenario)
+    # Out-of-range breakpoints are clipped onto the scan ends so every row has the same length.
+    x = np.sort(np.hstack([
+        np.broadcast_to(np.geomspace(x_min, x_max, samples), (breaks.shape[0], samples)),
+        np.clip(breaks, x_min, x_max), np.clip(np.nextafter(breaks, 0.0), x_min, x_max)
+    ]), axis=1)
+    rows = np.arange(x.shape[0])
+    C = scenario.concentration(x, y_receptor, z_receptor)
+    best = np.argmax(C, axis=1)
+    best_x, best_c = x[rows, best], C[rows, best]
+    # Bracket with the nearest distinct neighbours, as the clipped rows may repeat values.
+    low = x[rows, np.maximum((x < best_x[:, None]).sum(axis=1) - 1, 0)]
+    high = x[rows, np.minimum((x <= best_x[:, None]).sum(axis=1), x.shape[1] - 1)]
+    steps = np.arange(refine_samples)
+    for _ in range(refine_steps):
+        # Row-wise np.linspace(low, high, refine_samples)
+        x = steps * ((high - low) / (refine_samples - 1))[:, None] + low[:, None]
+        x[:, -1] = high
+        C = scenario.concentration(x, y_receptor, z_receptor)
+        k = np.argmax(C, axis=1)
+        improved = C[rows, k] > best_c
+        best_x = np.where(improved, x[rows, k], best_x)
+        best_c = np.where(improved, C[rows, k], best_c)
+        low, high = x[rows, np.maximum(k - 1, 0)], x[rows, np.minimum(k + 1, refine_samples - 1)]
+    return best_x, best_c
+
+def find_max_concentration(params, z_receptor=0.0, y_receptor=0.0, x_min=1.0, x_max=100000.0,
+                           samples=400, refine_samples=33, refine_steps=6):
+    # Locates the maximum of C(x) along a line parallel to the plume axis (the centerline
+    # by default). A log-spaced coarse scan that also includes both sides of every
+    # breakpoint brackets the peak; each refinement step re-samples the bracket around
+    # the current best point. Returns (x at the maximum, maximum concentration).
+    best_x, best_c = find_max_concentrations(compile_scenario(params), z_receptor, y_receptor, x_min, x_max,
+                                             samples, refine_samples, refine_steps)
+    return float(best_x[0]), float(best_c[0])
+
+# ---------------------------------------------------------------------------
+# Direct Raster Renderer: colormap lookup table encoded straight to an image
+# ---------------------------------------------------------------------------
+PLOT_RENDERER = os.environ.get("PLOT_RENDERER", "matplotlib")  # "matplotlib" or "raster"
+PLOT_FORMAT = os.environ.get("PLOT_FORMAT", "png")  # raster mode only: "png", "webp" or "jpeg"
+RASTER_PLOT_SIZE = (640, 400)  # plot area in pixels (width, height)
+RASTER_MARGIN = 12
+
+def _build_jet_lut(n=256):
+    # Same piecewise-linear segments as matplotlib's 'jet', without importing matplotlib.
+    t = np.linspace(0.0, 1.0, n)
+    red = np.interp(t, [0, 0.35, 0.66, 0.89, 1], [0, 0, 1, 1, 0.5])
+    green = np.interp(t, [0, 0.125, 0.375, 0.64, 0.91, 1], [0, 0, 1, 1, 0, 0])
+    blue = np.interp(t, [0, 0.11, 0.34, 0.65, 1], [0.5, 1, 1, 0, 0])
+    return np.round(np.stack([red, green, blue], axis=1) * 255).astype(np.uint8)
+
+_JET_LUT = _build_jet_lut()
+
+# 3x5 bitmap glyphs for colorbar labels, one string of 15 bits per character (row-major).
+_GLYPHS = {
+    '0': '111101101101111', '1': '010110010010111', '2': '111001111100111', '3': '111001111001111',
+    '4': '101101111001001', '5': '111100111001111', '6': '111100111101111', '7': '111001001001001',
+    '8': '111101111101111', '9': '111101111001111', '.': '000000000000010', '-': '000000111000000',
+    '+': '000010111010000', 'e': '000111101110011', ' ': '000000000000000',
+}
+
+def _draw_text(image, text, top, left, scale=2, color=(0, 0, 0)):
+    for k, char in enumerate(text):
+        bits = np.array([bit == '1' for bit in _GLYPHS.get(char, _GLYPHS[' '])]).reshape(5, 3)
+        block = np.kron(bits, np.ones((scale, scale), dtype=bool))
+        x0 = left + k * 4 * scale
+        region = image[top:top + block.shape[0], x0:x0 + block.shape[1]]
+        region[block[:region.shape[0], :region.shape[1]]] = color
+
+def _encode_png(rgb):
+    height, width, _ = rgb.shape
+    def chunk(tag, data):
+        return (struct.pack('>I', len(data)) + tag + data +
+                struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+    # Filter type 0 (None) on every scanline; flat colour blocks still deflate well.
+    raw = np.hstack([np.zeros((height, 1), dtype=np.uint8), rgb.reshape(height, width * 3)]).tobytes()
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b''))
+
+def encode_image(rgb, image_format):
+    if image_format == 'png':
+        return _encode_png(rgb)
+    try:
+        from PIL import Image
+    except ImportError:
+        logger.warning("Pillow is not installed; encoding the %s plot as PNG instead", image_format)
+        return _encode_png(rgb)
+    buf = io.BytesIO()
+    Image.fromarray(rgb).save(buf, format=image_format.upper(), quality=85)
+    return buf.getvalue()
+
+def _nearest_index(points, values):
+    upper = np.clip(np.searchsorted(points, values), 1, len(points) - 1)
+    return np.where(values - points[upper - 1] < points[upper] - values, upper - 1, upper)
+
+def render_concentration_raster(x_points, y_points, Z, markers, image_format='png'):
+    # Z is indexed [y, x] on monotonic axes; cells are mapped to pixels by nearest neighbour.
+    started = time.perf_counter()
+    width, height = RASTER_PLOT_SIZE
+    margin = RASTER_MARGIN
+    vmax = float(np.nanmax(Z)) if np.isfinite(np.nanmax(Z)) and np.nanmax(Z) > 0 else 1.0
+    levels = np.clip(np.nan_to_num(Z / vmax) * 255, 0, 255).astype(np.uint8)
+
+    px = np.linspace(x_points[0], x_points[-1], width)
+    py = np.linspace(y_points[-1], y_points[0], height)  # image rows run from +y down to -y
+    cols = _nearest_index(x_points, px)
+    rows = _nearest_index(y_points, py)
+    plot_rgb = _JET_LUT[levels[np.ix_(rows, cols)]]
+
+    bar_width, label_width = 18, 10 * 8
+    image = np.full((height + 2 * margin, margin + width + margin + bar_width + 6 + label_width + margin, 3),
+                    255, dtype=np.uint8)
+    image[margin:margin + height, margin:margin + width] = plot_rgb
+    bar_left = margin + width + margin
+    bar = _JET_LUT[np.linspace(255, 0, height).astype(np.uint8)]
+    image[margin:margin + height, bar_left:bar_left + bar_width] = bar[:, None, :]
+
+    label_left = bar_left + bar_width + 6
+    for fraction in (1.0, 0.5, 0.0):
+        top = margin + int(round((1 - fraction) * (height - 10)))
+        _draw_text(image, f"{fraction * vmax:.3g}", top, label_left)
+
+    for marker_x, marker_y in markers:
+        if not (x_points[0] <= marker_x <= x_points[-1] and y_points[0] <= marker_y <= y_points[-1]):
+            continue
+        mx = margin + int(round((marker_x - x_points[0]) / (x_points[-1] - x_points[0]) * (width - 1)))
+        my = margin + int(round((y_points[-1] - marker_y) / (y_points[-1] - y_points[0]) * (height - 1)))
+        image[my - 1:my + 2, max(mx - 8, margin):mx + 9] = 255
+        image[max(my - 8, margin):my + 9, mx - 1:mx + 2] = 255
+
+    record_stage('render', time.perf_counter() - started)
+    with stage_timer('encode'):
+        return encode_image(image, image_format)
+
+PLOT_GRID = os.environ.get("PLOT_GRID", "fixed")  # "fixed" 80x80 linspace or "adaptive"
+ADAPTIVE_GRID_SHAPE = (60, 61)  # (x samples, y samples); 3,660 evaluations vs 6,400 fixed
+ADAPTIVE_CUTOFF = 0.05  # the map extends to where the centerline falls below this fraction of its peak
+
+def adaptive_plot_axes(scenario, single_point_coords):
+    # Extent from a cheap 1-D centerline scan: x is log-spaced between where the plume
+    # first and last exceeds ADAPTIVE_CUTOFF of its peak, and y is sinh-stretched so the
+    # finest spacing (about a third of σye at the peak) sits on the plume axis.
+    nx, ny = ADAPTIVE_GRID_SHAPE
+    z = single_point_coords['z']
+    scan_x = np.geomspace(1.0, 100000.0, 200)
+    profile = scenario.concentration(scan_x, 0.0, z)
+    peak = int(np.argmax(profile))
+    if profile[peak] > 0:
+        above = np.nonzero(profile >= ADAPTIVE_CUTOFF * profile[peak])[0]
+        x_min, x_max = scan_x[max(above[0] - 1, 0)], scan_x[min(above[-1] + 1, len(scan_x) - 1)]
     else:
-        if is_buoyancy_dominated: he = h_prime_s + 1.6 * ((Fb * x_receptor**2) / us**3)**(1/3)
-        else:
-            Fm = (vs_stack_velocity**2) * (ds_stack_diameter**2) * (Ta_ambient_temp / (4 * Ts_stack_temp))
-            beta_j = (1/3) + (us / vs_stack_velocity)
-            if is_stable: he = h_prime_s + 1.6 * ((Fm * x_receptor**2) / (beta_j**2 * us**2))**(1/3)
-            else: he = h_prime_s + ((3 * Fm * x_receptor) / (beta_j**2 * us**2))**(1/3)
-        trace_log += f"گام ۴.۷: چون x < xf، از فرمول خیز تدریجی استفاده شد. he = {he:.2f} متر\n\n"
-
-    # Step 9: Calculate effective sigmas
-    sigma_ye = np.sqrt(sigma_y**2 + (delta_h / 3.5)**2)
-    sigma_ze = np.sqrt(sigma_z**2 + (delta_h / 3.5)**2)
-    trace_log += f"--- ۵. محاسبه ضرایب پراکندگی موثر ---\n"
-    trace_log += f"σye = (σy² + (Δh/3.5)²)^0.5 = {sigma_ye:.2f} متر\n"
-    trace_log += f"σze = (σz² + (Δh/3.5)²)^0.5 = {sigma_ze:.2f} متر\n\n"
-    
-    # Step 8: Calculate the vertical term (V)
-    if sigma_ze == 0: sigma_ze = 1e-6
-    term1 = np.exp(-0.5 * ((z_receptor - he) / sigma_ze)**2)
-    term2 = np.exp(-0.5 * ((z_receptor + he) / sigma_ze)**2)
-    V = term1 + term2
-    summation_term = 0
-    for i in range(1, 6):
-        H1 = z_receptor - (2 * i * Hm_boundary_layer - he); H2 = z_receptor + (2 * i * Hm_boundary_layer - he)
-        H3 = z_receptor - (2 * i * Hm_boundary_layer + he); H4 = z_receptor + (2 * i * Hm_boundary_layer + he)
-        summation_term += (np.exp(-0.5 * (H1 / sigma_ze)**2) + np.exp(-0.5 * (H2 / sigma_ze)**2) +
-                           np.exp(-0.5 * (H3 / sigma_ze)**2) + np.exp(-0.5 * (H4 / sigma_ze)**2))
-    V += summation_term
-    trace_log += f"--- ۶. محاسبه جمله قائم (V) ---\n"
-    trace_log += f"با در نظر گرفتن انعکاس از زمین و لایه مرزی، V = {V:.4f}\n\n"
-    
-    # Step 10: Calculate the decay term (D)
-    trace_log += f"--- ۷. محاسبه جمله زوال (D) ---\n"
-    if T_half_life > 0:
-        psi = 0.693 / T_half_life
-        D = np.exp(-psi * x_receptor / us)
-        trace_log += f"با نیمه عمر {T_half_life} ثانیه، ضریب زوال ψ = {psi:.4e}\n"
-        trace_log += f"مقدار D = exp(-ψ * x / Us) = {D:.4f}\n\n"
-    else: 
-        D = 1.0
-        trace_log += f"آلاینده پایدار فرض شد (نیمه عمر=0)، D = 1.0\n\n"
-        
-    # Final Step: Calculate concentration (C)
-    trace_log += f"--- ۸. محاسبه غلظت نهایی (C) ---\n"
-    K = 1e6
-    if sigma_ye == 0: sigma_ye = 1e-6
-    lateral_term = np.exp(-0.5 * (y_receptor / sigma_ye)**2)
-    denominator = 2 * np.pi * us * sigma_ye * sigma_ze
-    if denominator == 0: return np.inf, trace_log
-    C = (Q_emission * K * V * D / denominator) * lateral_term
-    trace_log += f"C = (Q*K*V*D) / (2*π*Us*σye*σze) * exp[-0.5*(y/σye)²]\n"
-    trace_log += f"C = ({Q_emission} * {K:.0f} * {V:.2f} * {D:.2f}) / (2*π*{us:.2f}*{sigma_ye:.2f}*{sigma_ze:.2f}) * exp[-0.5*({y_receptor}/{sigma_ye:.2f})²]\n"
-    
-    return C, trace_log
+        x_min, x_max = 1.0, 10000.0
+    x_max = max(x_max, 1.1 * single_point_coords['x'], 3 * x_min)
+    if single_point_coords['x'] > 0: x_min = min(x_min, 0.9 * single_point_coords['x'])
+    x_points = np.geomspace(x_min, x_max, nx)
 
-def generate_plot_for_telegram(params, single_point_coords):
+    sigma_y, sigma_z = scenario.dispersion_coefficients(np.array([scan_x[peak], x_max]))
+    sigma_ye, _ = scenario.effective_sigmas(sigma_y, sigma_z)
+    y_max = max(3.5 * sigma_ye[1], 1.1 * abs(single_point_coords['y']), 10.0)
+    finest = max(sigma_ye[0] / 3, 1e-3)
+    # Solve y_max*sinh(a*s)/sinh(a) ≈ finest at the first step s = 2/(ny-1) by bisection on a.
+    step = 2.0 / (ny - 1)
+    low, high = 1e-6, 50.0
+    for _ in range(60):
+        a = 0.5 * (low + high)
+        if y_max * np.sinh(a * step) / np.sinh(a) > finest: low = a
+        else: high = a
+    s = np.linspace(-1.0, 1.0, ny)
+    y_points = y_max * np.sinh(a * s) / np.sinh(a)
+    return x_points, y_points
+
+def plot_axes(scenario, single_point_coords):
+    if PLOT_GRID == 'adaptive':
+        return adaptive_plot_axes(scenario, single_point_coords)
+    return fixed_plot_axes()
+
+def fixed_plot_axes():
     grid_resolution = 80
     x_max_m = 10000; y_max_m = 2000
     x_points = np.linspace(1, x_max_m, grid_resolution)
     y_points = np.linspace(-y_max_m, y_max_m, grid_resolution)
+    return x_points, y_points
+
+def plot_grid(scenario, single_point_coords):
+    with stage_timer('grid'):
+        x_points, y_points = plot_axes(scenario, single_point_coords)
+        X, Y = np.meshgrid(x_points, y_points)
+        Z = scenario.concentration(X, Y, single_point_coords['z'])
+    return x_points, y_points, Z
+
+def generate_plot_for_telegram(params, single_point_coords):
+    global _first_render_done
+    started = time.perf_counter()
+    # params may be a user_data style dict or an already compiled PlumeScenario.
+    scenario = compile_scenario(params)
+    x_points, y_points, Z = plot_grid(scenario, single_point_coords)
+    if PLOT_RENDERER == 'raster':
+        buf = io.BytesIO(render_concentration_raster(
+            x_points, y_points, Z, [(single_point_coords['x'], single_point_coords['y'])], PLOT_FORMAT
+        ))
+    else:
+        buf = _render_matplotlib_plot(
+            x_points, y_points, Z, [(single_point_coords['x'], single_point_coords['y'])], "نقطه انتخابی کاربر",
+            f'نمودار توزیع غلظت در ارتفاع {single_point_coords["z"]} متری',
+            'فاصله در راستای باد (متر)', 'فاصله عرضی از محور (متر)'
+        )
+    if not _first_render_done:
+        _first_render_done = True
+        logger.info("First render in process %d took %.3f s", os.getpid(), time.perf_counter() - started)
+    return buf
+
+def _render_matplotlib_plot(x_points, y_points, Z, markers, marker_label, title, xlabel, ylabel):
+    Figure = load_plotting()
     X, Y = np.meshgrid(x_points, y_points)
-    Z = np.zeros_like(X)
-    plot_height_z = single_point_coords['z']
-    for i in range(X.shape[0]):
-        for j in range(X.shape[1]):
-            conc, _ = calculate_concentration(
-                x_receptor=X[i, j], y_receptor=Y[i, j], z_receptor=plot_height_z, **params
-            )
-            Z[i, j] = conc
-    fig, ax = plt.subplots(figsize=(10, 7))
+    # The object-oriented Figure API keeps rendering free of pyplot's global state,
+    # so plots can be drawn concurrently from worker threads.
+    fig = Figure(figsize=(10, 7))
+    ax = fig.subplots()
     contour = ax.pcolormesh(X, Y, Z, cmap='jet', shading='auto', vmin=0)
     cbar = fig.colorbar(contour, ax=ax)
     cbar.set_label('غلظت (μg/m³)')
-    ax.plot(single_point_coords['x'], single_point_coords['y'], 'w+', markersize=10, label=f"نقطه انتخابی کاربر")
+    marker_x, marker_y = zip(*markers)
+    ax.plot(marker_x, marker_y, 'w+', markersize=10, linestyle='none', label=marker_label)
     ax.legend()
-    ax.set_title(f'نمودار توزیع غلظت در ارتفاع {plot_height_z} متری')
-    ax.set_xlabel('فاصله در راستای باد (متر)')
-    ax.set_ylabel('فاصله عرضی از محور (متر)')
-    buf = io.BytesIO()
-    plt.savefig(buf, format='PNG')
+    ax.set_title(title)
+    ax.set_xlabel(xlabel)
+    ax.set_ylabel(ylabel)
+    # Drawn and encoded separately (what savefig does in one call) so each step is timed.
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.image import imsave
+    with stage_timer('render'):
+        canvas = FigureCanvasAgg(fig)
+        canvas.draw()
+    with stage_timer('encode'):
+        buf = io.BytesIO()
+        imsave(buf, np.asarray(canvas.buffer_rgba()), format='png', dpi=fig.dpi)
     buf.seek(0)
-    plt.close(fig)
     return buf
 
+# ---------------------------------------------------------------------------
+# Multi-Source Superposition: several stacks sharing one meteorology
+# ---------------------------------------------------------------------------
+MET_PARAM_NAMES = ('u_ref', 'z_ref', 'stability_class', 'area_type', 'Hm_boundary_layer', 'Ta_ambient_temp')
+STACK_PARAM_NAMES = ('x', 'y', 'Q_emission', 'ds_stack_diameter', 'hs_stack_height', 'Ts_stack_temp',
+                     'vs_stack_velocity', 'T_half_life')
+MULTI_SOURCE_CHUNK_ELEMENTS = 2_000_000  # sources x receptors evaluated per batch
+
+def stack_scenarios(scenarios):
+    # Builds one PlumeScenario whose per-source terms are (S, 1) columns, so a single call
+    # of its receptor methods on (S, N) arrays evaluates every source at once. All
+    # scenarios must share the stability class and area type.
+    first = scenarios[0]
+    for scenario in scenarios[1:]:
+        if (scenario.stability_class, scenario.area_type) != (first.stability_class, first.area_type):
+            raise ValueError("Stacked scenarios must share stability class and area type")
+    stacked = PlumeScenario.__new__(PlumeScenario)
+    for name in PlumeScenario.__slots__:
+        values = [getattr(scenario, name) for scenario in scenarios]
+        if name in ('params', 'stability_class', 'area_type', 'is_stable', 'p'):
+            setattr(stacked, name, None if name == 'params' else values[0])
+        else:
+            setattr(stacked, name, np.array(values, dtype=float if name != 'is_buoyancy_dominated' else bool)[:, None])
+    return stacked
+
+def to_plume_frame(x_receptor, y_receptor, x_source, y_source, wind_direction):
+    # wind_direction is the meteorological direction the wind blows FROM, in degrees
+    # clockwise from north, with site x pointing east and y pointing north.
+    toward = np.deg2rad(wind_direction + 180.0)
+    ux, uy = np.sin(toward), np.cos(toward)
+    dx = x_receptor - x_source
+    dy = y_receptor - y_source
+    return dx * ux + dy * uy, dy * ux - dx * uy
+
+def calculate_multi_source_concentration(met, stacks, x_receptor, y_receptor, z_receptor, wind_direction=270.0):
+    # Superposes the plumes of several stacks (dicts with STACK_PARAM_NAMES) under one
+    # meteorology (MET_PARAM_NAMES) on site-frame receptors of any shape.
+    scenarios = [compile_scenario({**met, **stack}) for stack in stacks]
+    stacked = stack_scenarios(scenarios)
+    x_source = np.array([stack['x'] for stack in stacks], dtype=float)[:, None]
+    y_source = np.array([stack['y'] for stack in stacks], dtype=float)[:, None]
+    x, y, z = np.broadcast_arrays(
+        np.asarray(x_receptor, dtype=float), np.asarray(y_receptor, dtype=float),
+        np.asarray(z_receptor, dtype=float)
+    )
+    shape = x.shape
+    x, y, z = x.ravel(), y.ravel(), z.ravel()
+    total = np.empty(x.shape)
+    chunk = max(1, MULTI_SOURCE_CHUNK_ELEMENTS // len(stacks))
+    for start in range(0, x.size, chunk):
+        check_compute_cancelled()
+        end = min(start + chunk, x.size)
+        downwind, crosswind = to_plume_frame(x[None, start:end], y[None, start:end], x_source, y_source, wind_direction)
+        total[start:end] = stacked.concentration(downwind, crosswind, z[None, start:end]).sum(axis=0)
+    return total.reshape(shape)
+
+def site_grid(stacks, padding=5000.0, resolution=100):
+    xs = [stack['x'] for stack in stacks]
+    ys = [stack['y'] for stack in stacks]
+    x_points = np.linspace(min(xs) - padding, max(xs) + padding, resolution)
+    y_points = np.linspace(min(ys) - padding, max(ys) + padding, resolution)
+    return x_points, y_points
+
+def generate_site_plot(met, stacks, wind_direction, z_receptor=0.0, padding=5000.0, resolution=100):
+    x_points, y_points = site_grid(stacks, padding, resolution)
+    X, Y = np.meshgrid(x_points, y_points)
+    Z = calculate_multi_source_concentration(met, stacks, X, Y, z_receptor, wind_direction)
+    markers = [(stack['x'], stack['y']) for stack in stacks]
+    if PLOT_RENDERER == 'raster':
+        png = render_concentration_raster(x_points, y_points, Z, markers, PLOT_FORMAT)
+    else:
+        png = _render_matplotlib_plot(
+            x_points, y_points, Z, markers, "دودکش‌ها",
+            f'غلظت مجموع {len(stacks)} دودکش در ارتفاع {z_receptor} متری (باد از {wind_direction}°)',
+            'شرق (متر)', 'شمال (متر)'
+        ).getvalue()
+    i, j = np.unravel_index(np.argmax(Z), Z.shape)
+    return png, float(Z[i, j]), float(x_points[j]), float(y_points[i])
+
+# ---------------------------------------------------------------------------
+# Bulk Receptors: CSV/TSV in, streamed CSV results out
+# ---------------------------------------------------------------------------
+BULK_CHUNK_ROWS = int(os.environ.get("BULK_CHUNK_ROWS", "50000"))
+BULK_MAX_UPLOAD_BYTES = 45 * 1024 * 1024  # larger results are gzipped before upload
+TELEGRAM_MAX_DOCUMENT_BYTES = 50 * 1024 * 1024  # Bot API upload limit
+
+def _open_csv(path):
+    # Returns (file, reader, header) with the delimiter sniffed from the first 64 KB.
+    f = open(path, newline='', encoding='utf-8-sig')
+    sample = f.read(64 * 1024)
+    f.seek(0)
+    try:
+        dialect = csv.Sniffer().sniff(sample, delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.reader(f, dialect)
+    header = next(reader, None)
+    if header is None:
+        f.close()
+        raise ValueError("empty file")
+    return f, reader, header
+
+def open_receptor_csv(path):
+    # Returns (file, reader, header, column indexes of x, y, z).
+    f, reader, header = _open_csv(path)
+    names = [name.strip().lower() for name in header]
+    missing = [axis for axis in ('x', 'y', 'z') if axis not in names]
+    if missing:
+        f.close()
+        raise ValueError(f"missing columns: {', '.join(missing)}")
+    return f, reader, header, tuple(names.index(axis) for axis in ('x', 'y', 'z'))
+
+def read_receptor_chunk(reader, columns, chunk_rows):
+    # Rows whose x/y/z do not parse get NaN coordinates and an empty result.
+    rows = list(itertools.islice(reader, chunk_rows))
+    coords = np.full((len(rows), 3), np.nan)
+    for k, row in enumerate(rows):
+        try:
+            coords[k] = [float(row[column]) for column in columns]
+        except (ValueError, IndexError):
+            pass
+    return rows, coords
+
+def write_result_chunk(writer, rows, concentration):
+    writer.writerows(
+        row + ['' if np.isnan(value) else f"{value:.6g}"] for row, value in zip(rows, concentration)
+    )
+
+def evaluate_receptor_chunk(scenario, coords):
+    valid = ~np.isnan(coords).any(axis=1)
+    concentration = np.full(len(coords), np.nan)
+    concentration[valid] = scenario.concentration(coords[valid, 0], coords[valid, 1], coords[valid, 2])
+    return concentration
+
+def gzip_file(path):
+    with open(path, 'rb') as src, gzip.open(path + '.gz', 'wb') as dst:
+        for block in iter(functools.partial(src.read, 4 * 1024 * 1024), b''):
+            check_compute_cancelled()
+            dst.write(block)
+    return path + '.gz'
+
+# ---------------------------------------------------------------------------
+# Meteorology Time Series: streaming long-term statistics on a fixed grid
+# ---------------------------------------------------------------------------
+MET_CHUNK_ROWS = int(os.environ.get("MET_CHUNK_ROWS", "256"))
+# Distinct meteorology cases evaluated per stacked call once the whole file is counted.
+MET_CASE_BATCH = int(os.environ.get("MET_CASE_BATCH", "64"))
+# Accepted header spellings for each hourly meteorology column.
+MET_COLUMN_ALIASES = {
+    'u_ref': ('u_ref', 'u', 'wind_speed'),
+    'stability_class': ('stability_class', 'stability', 'class'),
+    'Hm_boundary_layer': ('hm_boundary_layer', 'hm', 'mixing_height'),
+    'Ta_ambient_temp': ('ta_ambient_temp', 'ta', 'temperature'),
+}
+
+def open_met_csv(path):
+    # Returns (file, reader, {parameter name: column index}); the delimiter is sniffed.
+    f, reader, header = _open_csv(path)
+    names = [name.strip().lower() for name in header]
+    columns = {}
+    for param, aliases in MET_COLUMN_ALIASES.items():
+        found = [names.index(alias) for alias in aliases if alias in names]
+        if not found:
+            f.close()
+            raise ValueError(f"missing column: {param}")
+        columns[param] = found[0]
+    return f, reader, columns
+
+def read_met_cases(reader, columns, chunk_rows):
+    # Reads up to chunk_rows hourly records and groups identical meteorology:
+    # returns ({(u_ref, class, Hm, Ta): hours}, rows read, rows skipped). Callers merge the
+    # counts over the whole file so each distinct case is evaluated only once.
+    cases = collections.Counter()
+    rows = list(itertools.islice(reader, chunk_rows))
+    skipped = 0
+    for row in rows:
+        try:
+            case = (float(row[columns['u_ref']]), parse_parameter_value('stability_class', row[columns['stability_class']].strip()),
+                    float(row[columns['Hm_boundary_layer']]), float(row[columns['Ta_ambient_temp']]))
+        except (ValueError, IndexError):
+            skipped += 1
+            continue
+        cases[case] += 1
+    return cases, len(rows), skipped
+
+def evaluate_met_cases(params, cases, x_receptor, y_receptor, z_receptor):
+    # One concentration field per distinct meteorology, evaluated in a single stacked call
+    # per stability class; returns (list of cases, array of shape (cases, receptors)).
+    ordered = sorted(cases, key=lambda case: case[1])
+    fields = []
+    for _, group in itertools.groupby(ordered, key=lambda case: case[1]):
+        check_compute_cancelled()
+        group = list(group)
+        scenarios = [compile_scenario({**params, 'u_ref': u_ref, 'stability_class': stability_class,
+                                       'Hm_boundary_layer': Hm, 'Ta_ambient_temp': Ta})
+                     for u_ref, stability_class, Hm, Ta in group]
+        fields.append(stack_scenarios(scenarios).concentration(x_receptor[None, :], y_receptor[None, :], z_receptor))
+    return ordered, np.vstack(fields)
+
+class LongTermAccumulator:
+    # Running mean, maximum and top-N hourly values per receptor; memory is O(top_n x receptors)
+    # however many hours are added.
+    def __init__(self, n_receptors, top_n):
+        self.top_n = top_n
+        self.hours = 0
+        self.total = np.zeros(n_receptors)
+        self.maximum = np.zeros(n_receptors)
+        self.top = np.full((top_n, n_receptors), -np.inf)
+
+    def add(self, field, hours):
+        self.hours += hours
+        self.total += field * hours
+        np.maximum(self.maximum, field, out=self.maximum)
+        repeats = np.broadcast_to(field, (min(hours, self.top_n), field.size))
+        combined = np.vstack([self.top, repeats])
+        self.top = np.partition(combined, combined.shape[0] - self.top_n, axis=0)[-self.top_n:]
+
+    def add_cases(self, cases, fields, hours_by_case):
+        for case, field in zip(cases, fields):
+            self.add(field, hours_by_case[case])
+
+    def mean(self):
+        return self.total / max(self.hours, 1)
+
+    def nth_highest(self):
+        # The top_n-th highest hourly value, NaN where fewer hours were recorded.
+        nth = self.top.min(axis=0)
+        return np.where(np.isfinite(nth), nth, np.nan)
+
+def write_long_term_csv(path, x_receptor, y_receptor, accumulator):
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['x', 'y', 'mean_ug_m3', 'max_1h_ug_m3', f'rank{accumulator.top_n}_1h_ug_m3'])
+        for row in zip(x_receptor, y_receptor, accumulator.mean(), accumulator.maximum, accumulator.nth_highest()):
+            writer.writerow([f"{row[0]:.1f}", f"{row[1]:.1f}"] + [f"{value:.6g}" for value in row[2:]])
+
+def render_long_term_plot(x_points, y_points, field, title):
+    if PLOT_RENDERER == 'raster':
+        return render_concentration_raster(x_points, y_points, field, [], PLOT_FORMAT)
+    return _render_matplotlib_plot(
+        x_points, y_points, field, [(0.0, 0.0)], "دودکش", title,
+        'فاصله در راستای باد (متر)', 'فاصله عرضی از محور (متر)'
+    ).getvalue()
+
+# ---------------------------------------------------------------------------
+# Parameter Sweep: every combination of one or two inputs in one batched call
+# ---------------------------------------------------------------------------
+SWEEP_MAX_COMBINATIONS = 2500
+
+def parse_sweep_values(name, text):
+    # "start:stop:count" for numbers, "ABF"/"all" for stability_class, "rural/urban"/"both" for area_type.
+    if name == 'stability_class':
+        classes = 'ABCDEF' if text.lower() == 'all' else text.upper()
+        return [parse_parameter_value(name, value) for value in classes]
+    if name == 'area_type':
+        areas = ['rural', 'urban'] if text.lower() == 'both' else text.split('/')
+        return [parse_parameter_value(name, value) for value in areas]
+    if name not in SCENARIO_PARAM_NAMES and name not in ('x', 'y', 'z'):
+        raise ValueError(name)
+    parts = text.split(':')
+    if len(parts) == 3:
+        count = int(parts[2])
+        # Checked before building the list so a huge count cannot allocate it.
+        if not 1 <= count <= SWEEP_MAX_COMBINATIONS: raise ValueError(text)
+        return [float(value) for value in np.linspace(float(parts[0]), float(parts[1]), count)]
+    return [float(value) for value in text.split('/')]
+
+def evaluate_parameter_sweep(base_params, point, sweeps):
+    # base_params/point: the saved scenario and receptor; sweeps: [(name, values), ...].
+    # Returns arrays shaped like the sweep grid: C at the receptor, maximum centerline
+    # ground-level C and its distance (the same search as /maxconc). Combinations sharing
+    # a stability class and area type are stacked and evaluated together.
+    names = [name for name, _ in sweeps]
+    shape = tuple(len(values) for _, values in sweeps)
+    combos = [dict(zip(names, values)) for values in itertools.product(*(values for _, values in sweeps))]
+    at_point = np.empty(len(combos))
+    c_max = np.empty(len(combos))
+    x_at_max = np.empty(len(combos))
+    def group_key(k):
+        merged = {**base_params, **combos[k]}
+        return merged['stability_class'], merged['area_type']
+    for _, group in itertools.groupby(sorted(range(len(combos)), key=group_key), key=group_key):
+        check_compute_cancelled()
+        group = list(group)
+        stacked = stack_scenarios([compile_scenario({**base_params, **combos[k]}) for k in group])
+        receptor = {axis: np.array([[combos[k].get(axis, point[axis])] for k in group]) for axis in ('x', 'y', 'z')}
+        at_point[group] = stacked.concentration(receptor['x'], receptor['y'], receptor['z'])[:, 0]
+        x_at_max[group], c_max[group] = find_max_concentrations(stacked)
+    return at_point.reshape(shape), c_max.reshape(shape), x_at_max.reshape(shape)
+
+def format_sweep_table(sweeps, at_point, c_max, x_at_max):
+    def label(value):
+        return value if isinstance(value, str) else f"{value:g}"
+    (name1, values1) = sweeps[0]
+    if len(sweeps) == 1:
+        width = max(12, len(name1))
+        lines = [f"{name1:>{width}} | C(receptor) | max GLC | x(max)"]
+        for k, value in enumerate(values1):
+            lines.append(f"{label(value):>{width}} | {at_point[k]:11.4g} | {c_max[k]:7.4g} | {x_at_max[k]:.0f}")
+        return "\n".join(lines)
+    (name2, values2) = sweeps[1]
+    lines = [f"C(receptor): {name1} ↓  {name2} →", " " * 10 + "".join(f"{label(v):>10}" for v in values2)]
+    for i, value in enumerate(values1):
+        lines.append(f"{label(value):>10}" + "".join(f"{at_point[i, j]:10.3g}" for j in range(len(values2))))
+    return "\n".join(lines)
+
+def render_sweep_chart(sweeps, at_point, c_max):
+    Figure = load_plotting()
+    (name1, values1) = sweeps[0]
+    positions = np.arange(len(values1)) if isinstance(values1[0], str) else np.array(values1)
+    fig = Figure(figsize=(10, 4.5))
+    ax_point, ax_max = fig.subplots(1, 2)
+    series = [(None, at_point[:, None], c_max[:, None])] if len(sweeps) == 1 else \
+        [(f"{sweeps[1][0]}={value}", at_point[:, [j]], c_max[:, [j]]) for j, value in enumerate(sweeps[1][1])]
+    for label, point_values, max_values in series:
+        ax_point.plot(positions, point_values[:, 0], marker='o', label=label)
+        ax_max.plot(positions, max_values[:, 0], marker='o', label=label)
+    for ax, title in ((ax_point, 'غلظت در نقطه گیرنده'), (ax_max, 'بیشینه غلظت سطح زمین')):
+        ax.set_title(title)
+        ax.set_xlabel(name1)
+        ax.set_ylabel('μg/m³')
+        if isinstance(values1[0], str):
+            ax.set_xticks(positions, values1)
+        if len(sweeps) > 1:
+            ax.legend(fontsize='small')
+    fig.tight_layout()
+    buf = io.BytesIO()
+    fig.savefig(buf, format='PNG')
+    return buf.getvalue()
+
+# ---------------------------------------------------------------------------
+# Volume Mode: (z, y, x) lattices sharing the z-independent terms across heights
+# ---------------------------------------------------------------------------
+VOLUME_HEIGHTS = (0.0, 1.5, 10.0, 30.0)  # ground, breathing height, low and high roofs
+VOLUME_SECTION_LEVELS = 120  # heights in the x-z cross-section along the plume axis
+VOLUME_EXPORT_SHAPE = (40, 200, 200)  # default (nz, ny, nx) of the exported lattice
+VOLUME_MAX_ELEMENTS = 50_000_000
+
+def concentration_volume(scenario, x_points, y_points, z_levels, out=None):
+    # C[k, j, i] at (x_points[i], y_points[j], z_levels[k]). Sigmas, he, the lateral
+    # term and decay are computed once; each height only adds the vertical term V.
+    # `out` may be a memory-mapped array, filled one height at a time.
+    scenario = compile_scenario(scenario)
+    x = np.asarray(x_points, dtype=float)
+    y = np.asarray(y_points, dtype=float)
+    valid = x > 0
+    x = np.where(valid, x, 1.0)
+    sigma_y, sigma_z = scenario.dispersion_coefficients(x)
+    sigma_ye, sigma_ze = scenario.effective_sigmas(sigma_y, sigma_z)
+    he = scenario.effective_height(x)
+    horizontal = scenario.combine(1.0, scenario.decay_term(x), scenario.lateral_term(y[:, None], sigma_ye),
+                                  sigma_ye, sigma_ze)
+    horizontal = np.where(valid, horizontal, 0.0)
+    if out is None: out = np.empty((len(z_levels), len(y), len(x)))
+    for k, z in enumerate(z_levels):
+        check_compute_cancelled()
+        out[k] = scenario.vertical_term(z, he, sigma_ze) * horizontal
+    return out
+
+def section_heights(scenario, x_points):
+    # Up to three times the highest plume centreline, within the mixing layer.
+    scenario = compile_scenario(scenario)
+    he_max = float(np.max(scenario.effective_height(np.asarray(x_points, dtype=float))))
+    return np.linspace(0.0, min(scenario.Hm_boundary_layer, max(3 * he_max, 100.0)), VOLUME_SECTION_LEVELS)
+
+def render_volume_plot(scenario, single_point_coords, heights):
+    # One horizontal panel per height on a shared colour scale, plus the x-z section at y = 0.
+    with stage_timer('grid'):
+        x_points, y_points = plot_axes(compile_scenario(scenario), single_point_coords)
+        volume = concentration_volume(scenario, x_points, y_points, heights)
+        z_section = section_heights(scenario, x_points)
+        section = concentration_volume(scenario, x_points, [0.0], z_section)[:, 0, :]
+    Figure = load_plotting()
+    rows = (len(heights) + 1) // 2
+    fig = Figure(figsize=(12, 4 * rows + 4), layout='constrained')
+    grid = fig.add_gridspec(rows + 1, 2)
+    vmax = float(np.nanmax(volume)) or 1.0
+    for k, z in enumerate(heights):
+        ax = fig.add_subplot(grid[k // 2, k % 2])
+        mesh = ax.pcolormesh(x_points, y_points, volume[k], cmap='jet', shading='auto', vmin=0, vmax=vmax)
+        ax.plot(single_point_coords['x'], single_point_coords['y'], 'w+', markersize=10)
+        ax.set_title(f'z = {z:g} m')
+        ax.set_xlabel('فاصله در راستای باد (متر)')
+        ax.set_ylabel('فاصله عرضی (متر)')
+    fig.colorbar(mesh, ax=[fig.axes[k] for k in range(len(heights))], label='غلظت (μg/m³)')
+    ax = fig.add_subplot(grid[rows, :])
+    mesh = ax.pcolormesh(x_points, z_section, section, cmap='jet', shading='auto', vmin=0)
+    ax.plot(x_points, compile_scenario(scenario).effective_height(np.asarray(x_points, dtype=float)), 'w--',
+            label='ارتفاع مؤثر (he)')
+    ax.legend()
+    ax.set_title('مقطع قائم x-z در امتداد محور دود (y = 0)')
+    ax.set_xlabel('فاصله در راستای باد (متر)')
+    ax.set_ylabel('ارتفاع (متر)')
+    fig.colorbar(mesh, ax=ax, label='غلظت (μg/m³)')
+    with stage_timer('render'):
+        buf = io.BytesIO()
+        fig.savefig(buf, format='PNG')
+    return buf.getvalue()
+
+def export_volume(scenario, single_point_coords, shape, workdir):
+    # Writes the (nz, ny, nx) lattice to a float32 .npy through a memory map, so only
+    # one height is held in memory, and the axes to a small .npz next to it.
+    nz, ny, nx = shape
+    x_points, y_points = plot_axes(compile_scenario(scenario), single_point_coords)
+    x_points = np.linspace(x_points[0], x_points[-1], nx)
+    y_points = np.linspace(y_points[0], y_points[-1], ny)
+    z_levels = np.linspace(0.0, section_heights(scenario, x_points)[-1], nz)
+    volume_path = os.path.join(workdir, 'volume.npy')
+    axes_path = os.path.join(workdir, 'volume_axes.npz')
+    volume = np.lib.format.open_memmap(volume_path, mode='w+', dtype=np.float32, shape=(nz, ny, nx))
+    concentration_volume(scenario, x_points, y_points, z_levels, out=volume)
+    volume.flush()
+    del volume
+    np.savez(axes_path, x=x_points, y=y_points, z=z_levels)
+    if os.path.getsize(volume_path) > BULK_MAX_UPLOAD_BYTES:
+        volume_path = gzip_file(volume_path)
+    return volume_path, axes_path
+
+# ---------------------------------------------------------------------------
+# Metrics: stage and handler timings, counters, Prometheus text exposition
+# ---------------------------------------------------------------------------
+METRICS_PORT = int(os.environ.get("METRICS_PORT", 0))  # polling mode; 0 disables the endpoint
+METRICS_LOG_INTERVAL = float(os.environ.get("METRICS_LOG_INTERVAL", 300))  # 0 disables the log summary
+METRICS_WINDOW = 2048  # recent samples per timer used for the quantiles
+METRICS_QUANTILES = (0.5, 0.95, 0.99)
+
+class MetricsRegistry:
+    # Timers keep a window of recent samples for quantiles plus lifetime count and sum;
+    # series are keyed by (metric, label name, label value).
+    def __init__(self, window):
+        self.window = window
+        self._lock = threading.Lock()
+        self._timers = {}
+        self._counters = collections.Counter()
+        self._gauges = {}
+
+    def observe(self, metric, label_name, label, seconds):
+        with self._lock:
+            timer = self._timers.get((metric, label_name, label))
+            if timer is None:
+                timer = self._timers[(metric, label_name, label)] = [collections.deque(maxlen=self.window), 0, 0.0]
+            timer[0].append(seconds)
+            timer[1] += 1
+            timer[2] += seconds
+
+    def increment(self, metric, label_name='', label='', amount=1):
+        with self._lock:
+            self._counters[(metric, label_name, label)] += amount
+
+    def gauge(self, metric, read, kind='gauge'):
+        # read() is called at scrape time; kind is the Prometheus type.
+        self._gauges[metric] = (read, kind)
+
+    def snapshot(self):
+        with self._lock:
+            timers = {key: (list(samples), count, total) for key, (samples, count, total) in self._timers.items()}
+            counters = dict(self._counters)
+        timers = {key: (np.quantile(samples, METRICS_QUANTILES), count, total)
+                  for key, (samples, count, total) in timers.items()}
+        return timers, counters
+
+    def render_prometheus(self):
+        timers, counters = self.snapshot()
+        def labels(label_name, label, extra=None):
+            parts = ([f'{label_name}="{label}"'] if label_name else []) + ([extra] if extra else [])
+            return '{' + ','.join(parts) + '}' if parts else ''
+        lines = []
+        for metric in sorted({key[0] for key in timers}):
+            lines.append(f"# TYPE {metric} summary")
+            for (name, label_name, label), (quantiles, count, total) in sorted(timers.items()):
+                if name != metric: continue
+                for q, value in zip(METRICS_QUANTILES, quantiles):
+                    quantile = 'quantile="%g"' % q
+                    lines.append(f"{metric}{labels(label_name, label, quantile)} {value:.6f}")
+                lines.append(f"{metric}_sum{labels(label_name, label)} {total:.6f}")
+                lines.append(f"{metric}_count{labels(label_name, label)} {count}")
+        for metric in sorted({key[0] for key in counters}):
+            lines.append(f"# TYPE {metric} counter")
+            for (name, label_name, label), value in sorted(counters.items()):
+                if name == metric: lines.append(f"{metric}{labels(label_name, label)} {value}")
+        for metric, (read, kind) in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {metric} {kind}")
+            lines.append(f"{metric} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        timers, counters = self.snapshot()
+        summary = {}
+        for (metric, _, label), (quantiles, count, _) in sorted(timers.items()):
+            entry = {'count': count}
+            entry.update({f"p{round(q * 100)}_ms": round(value * 1000, 2) for q, value in zip(METRICS_QUANTILES, quantiles)})
+            summary[f"{metric}.{label}"] = entry
+        summary.update({f"{metric}.{label}" if label else metric: value for (metric, _, label), value in sorted(counters.items())})
+        summary.update({metric: read() for metric, (read, _) in self._gauges.items()})
+        return summary
+
+metrics = MetricsRegistry(METRICS_WINDOW)
+_stage_collector = threading.local()
+
+def record_stage(stage, seconds):
+    # Inside a compute job the sample travels back with the result (the job may run in
+    # another process); everywhere else it goes straight to the registry.
+    samples = getattr(_stage_collector, 'samples', None)
+    if samples is not None: samples.append((stage, seconds))
+    else: metrics.observe('bot_stage_seconds', 'stage', stage, seconds)
+
+@contextlib.contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - started)
+
+def _collect_stage_timings(func, *args, **kwargs):
+    _stage_collector.samples = []
+    try:
+        return func(*args, **kwargs), _stage_collector.samples
+    finally:
+        _stage_collector.samples = None
+
+def timed_handler(callback):
+    # Per-handler latency and error counts; wraps the callbacks registered in main().
+    @functools.wraps(callback)
+    async def wrapper(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            metrics.increment('bot_handler_errors_total', 'handler', callback.__name__)
+            raise
+        finally:
+            metrics.observe('bot_handler_seconds', 'handler', callback.__name__, time.perf_counter() - started)
+    return wrapper
+
+def start_metrics_server(port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('0.0.0.0', port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logger.info("Serving metrics on port %d", port)
+    return server
+
+async def log_metrics_periodically(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info("metrics %s", json.dumps(metrics.summary(), sort_keys=True))
+
+# ---------------------------------------------------------------------------
+# Compute Executor: runs engine and plot work off the asyncio event loop
+# ---------------------------------------------------------------------------
+COMPUTE_EXECUTOR_KIND = os.environ.get("COMPUTE_EXECUTOR", "process")  # "process" or "thread"
+COMPUTE_MAX_WORKERS = int(os.environ.get("COMPUTE_MAX_WORKERS", min(4, os.cpu_count() or 1)))
+COMPUTE_QUEUE_LIMIT = int(os.environ.get("COMPUTE_QUEUE_LIMIT", "64"))
+
+class ComputeQueueFull(Exception):
+    pass
+
+class ComputeCancelled(Exception):
+    pass
+
+_compute_control = threading.local()
+
+def check_compute_cancelled():
+    # Called between the steps of long loops: a cancelled call in a thread worker stops
+    # here (process workers are terminated instead, so this is a no-op there).
+    cancelled = getattr(_compute_control, 'cancelled', None)
+    if cancelled is not None and cancelled.is_set(): raise ComputeCancelled()
+
+def _run_compute(func, cancelled, args, kwargs):
+    _compute_control.cancelled = cancelled
+    try:
+        return _collect_stage_timings(func, *args, **kwargs)
+    finally:
+        _compute_control.cancelled = None
+
+class ComputeUsage:
+    # Worker calls started by one job that have not finished yet, including calls the job
+    # stopped waiting for; when_idle callbacks run once none are left.
+    def __init__(self):
+        self.running = 0
+        self._idle_callbacks = []
+
+    def started(self):
+        self.running += 1
+
+    def finished(self):
+        self.running -= 1
+        if self.running == 0:
+            callbacks, self._idle_callbacks = self._idle_callbacks, []
+            for callback in callbacks: callback()
+
+    def when_idle(self, callback):
+        if self.running: self._idle_callbacks.append(callback)
+        else: callback()
+
+# Set by the job scheduler in each job's task, so its worker calls are counted against it.
+compute_usage = contextvars.ContextVar('compute_usage', default=None)
+
+class ComputeExecutor:
+    # At most max_workers jobs run at once and at most queue_limit more wait for a
+    # worker; anything beyond that is rejected with ComputeQueueFull. Every worker is its
+    # own single-worker pool, so an abandoned call can be stopped without touching the
+    # others: a process worker is terminated and replaced, a thread worker stops at its
+    # next check_compute_cancelled(). A call counts against the limits until its worker
+    # is actually free again.
+    def __init__(self, kind, max_workers, queue_limit):
+        if kind not in ('process', 'thread'):
+            raise ValueError(f"Unknown compute executor kind: {kind}")
+        self.kind = kind
+        self.max_workers = max(1, max_workers)
+        self.queue_limit = max(0, queue_limit)
+        self.in_flight = 0
+        self._idle = None  # asyncio.Queue of free workers, filled on first use
+        self._workers = set()
+
+    @property
+    def queue_depth(self):
+        return max(0, self.in_flight - self.max_workers)
+
+    @property
+    def is_full(self):
+        return self.in_flight >= self.max_workers + self.queue_limit
+
+    def _new_worker(self):
+        if self.kind == 'process':
+            worker = concurrent.futures.ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn'))
+        else:
+            worker = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='compute')
+        self._workers.add(worker)
+        return worker
+
+    def _get_idle(self):
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.max_workers):
+                self._idle.put_nowait(self._new_worker())
+            logger.info("Started %s compute pool with %d workers (queue limit %d)",
+                        self.kind, self.max_workers, self.queue_limit)
+        return self._idle
+
+    async def run(self, func, *args, **kwargs):
+        # in_flight is only touched from the event loop thread, so no lock is needed.
+        if self.is_full:
+            metrics.increment('bot_compute_rejected_total')
+            raise ComputeQueueFull()
+        self.in_flight += 1
+        idle = self._get_idle()
+        try:
+            worker = await idle.get()
+        except BaseException:
+            self.in_flight -= 1
+            raise
+        cancelled = threading.Event() if self.kind == 'thread' else None
+        usage = compute_usage.get()
+        try:
+            future = worker.submit(_run_compute, func, cancelled, args, kwargs)
+        except RuntimeError:
+            # The worker broke between calls (e.g. its process was killed); replace it.
+            self._release(worker, None, None)
+            raise
+        if usage is not None: usage.started()
+        loop = asyncio.get_running_loop()
+        future.add_done_callback(lambda done: loop.call_soon_threadsafe(self._release, worker, done, usage))
+        try:
+            result, stage_samples = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            self._abort(worker, future, cancelled)
+            raise
+        for stage, seconds in stage_samples:
+            metrics.observe('bot_stage_seconds', 'stage', stage, seconds)
+        return result
+
+    def _abort(self, worker, future, cancelled):
+        # The caller gave up (cancel or timeout); stop the work it left on the worker.
+        if future.done(): return
+        metrics.increment('bot_compute_aborted_total')
+        if cancelled is not None:
+            cancelled.set()
+        else:
+            # The pool has this one process only, so terminating it breaks nothing else;
+            # the future then fails with BrokenProcessPool and _release replaces the worker.
+            for process in list(worker._processes.values()):
+                process.terminate()
+
+    def _release(self, worker, future, usage):
+        # Runs on the event loop once the worker's call has really finished.
+        self.in_flight -= 1
+        if usage is not None: usage.finished()
+        if worker not in self._workers: return  # shut down meanwhile
+        broken = future is None or (not future.cancelled() and
+                                    isinstance(future.exception(), concurrent.futures.BrokenExecutor))
+        if broken:
+            self._workers.discard(worker)
+            worker.shutdown(wait=False, cancel_futures=True)
+            worker = self._new_worker()
+        self._idle.put_nowait(worker)
+
+    async def prewarm(self):
+        # One warm-up render per worker process; threads share a single import.
+        started = time.perf_counter()
+        jobs = self.max_workers if self.kind == 'process' else 1
+        await asyncio.gather(*(self.run(prewarm_renderer) for _ in range(jobs)))
+        logger.info("Pre-warmed %d %s worker(s) in %.3f s", jobs, self.kind, time.perf_counter() - started)
+
+    def shutdown(self):
+        for worker in self._workers:
+            worker.shutdown(wait=False, cancel_futures=True)
+        self._workers = set()
+        self._idle = None
+
+compute_executor = ComputeExecutor(COMPUTE_EXECUTOR_KIND, COMPUTE_MAX_WORKERS, COMPUTE_QUEUE_LIMIT)
+
+# ---------------------------------------------------------------------------
+# Job Scheduler: per-user fairness, timeouts and cancellation for compute jobs
+# ---------------------------------------------------------------------------
+JOB_SLOTS = int(os.environ.get("JOB_SLOTS", 0)) or COMPUTE_MAX_WORKERS  # jobs running at once
+USER_QUEUE_LIMIT = int(os.environ.get("USER_QUEUE_LIMIT", 2))  # jobs waiting behind a user's running one
+JOB_TIMEOUT = float(os.environ.get("JOB_TIMEOUT", 120))
+UPLOAD_JOB_TIMEOUT = float(os.environ.get("UPLOAD_JOB_TIMEOUT", 1800))  # /bulk and /timeseries files
+
+class JobAborted(Exception):
+    pass
+
+class JobQueueFull(JobAborted):
+    pass
+
+class JobTimeout(JobAborted):
+    pass
+
+class JobCancelled(JobAborted):
+    pass
+
+class JobScheduler:
+    # Each user has at most one running job; waiting users are served round-robin so a
+    # long backlog from one user cannot starve the others. A job runs in its own task, so
+    # timeouts and cancel() stop only that job; its slot is freed once the task has ended
+    # and the compute executor has stopped the worker calls it left behind.
+    def __init__(self, slots, user_queue_limit, timeout):
+        self.slots = slots
+        self.user_queue_limit = user_queue_limit
+        self.timeout = timeout
+        self._waiting = {}  # user_id -> deque of (ticket, func, args)
+        self._running = {}  # user_id -> job task
+        self._last_started = {}  # user_id -> sequence number of the user's latest job start
+        self._started = 0
+
+    @property
+    def queued(self):
+        return sum(len(queue) for queue in self._waiting.values())
+
+    @property
+    def running(self):
+        return len(self._running)
+
+    def _dispatch(self):
+        # Of the users with a waiting job and nothing running, the one whose last job
+        # started longest ago goes next.
+        while len(self._running) < self.slots:
+            ready = [user_id for user_id in self._waiting if user_id not in self._running]
+            if not ready: return
+            user_id = min(ready, key=lambda user_id: self._last_started.get(user_id, 0))
+            queue = self._waiting[user_id]
+            ticket, func, args = queue.popleft()
+            if not queue: del self._waiting[user_id]
+            self._started += 1
+            self._last_started[user_id] = self._started
+            usage = ComputeUsage()
+            task = asyncio.get_running_loop().create_task(self._run_job(usage, func, args))
+            task.add_done_callback(lambda task, user_id=user_id, usage=usage: usage.when_idle(
+                lambda: self._finish(user_id, task)))
+            self._running[user_id] = task
+            ticket.set_result(task)
+
+    @staticmethod
+    async def _run_job(usage, func, args):
+        compute_usage.set(usage)
+        return await func(*args)
+
+    def _finish(self, user_id, task):
+        if self._running.get(user_id) is task:
+            del self._running[user_id]
+            if user_id not in self._waiting: self._last_started.pop(user_id, None)
+            self._dispatch()
+
+    async def run(self, user_id, func, *args, timeout=None):
+        # Runs the coroutine function func(*args) as one of the user's jobs and returns its result.
+        if len(self._waiting.get(user_id, ())) >= self.user_queue_limit:
+            metrics.increment('bot_jobs_total', 'outcome', 'rejected')
+            raise JobQueueFull()
+        ticket = asyncio.get_running_loop().create_future()
+        self._waiting.setdefault(user_id, collections.deque()).append((ticket, func, args))
+        self._dispatch()
+        try:
+            task = await ticket
+        except asyncio.CancelledError:
+            if ticket.done() and not ticket.cancelled():
+                ticket.result().cancel()
+            else:
+                ticket.cancel()
+                self._discard(user_id, ticket)
+            raise
+        try:
+            done, _ = await asyncio.wait({task}, timeout=self.timeout if timeout is None else timeout)
+        finally:
+            if not task.done(): task.cancel()
+        if not done:
+            metrics.increment('bot_jobs_total', 'outcome', 'timeout')
+            raise JobTimeout()
+        if task.cancelled():
+            raise JobCancelled()
+        metrics.increment('bot_jobs_total', 'outcome', 'completed')
+        return task.result()
+
+    def _discard(self, user_id, ticket):
+        queue = self._waiting.get(user_id)
+        if queue is None: return
+        for entry in list(queue):
+            if entry[0] is ticket: queue.remove(entry)
+        if not queue: del self._waiting[user_id]
+
+    def cancel(self, user_id):
+        # Aborts the user's waiting and running jobs; returns how many were cancelled.
+        cancelled = 0
+        for ticket, _, _ in self._waiting.pop(user_id, ()):
+            ticket.set_exception(JobCancelled())
+            cancelled += 1
+        task = self._running.get(user_id)
+        if task is not None and not task.done():
+            task.cancel()
+            cancelled += 1
+        if cancelled: metrics.increment('bot_jobs_total', 'outcome', 'cancelled', cancelled)
+        return cancelled
+
+job_scheduler = JobScheduler(JOB_SLOTS, USER_QUEUE_LIMIT, JOB_TIMEOUT)
+
+# ---------------------------------------------------------------------------
+# Plot Cache: content-addressed PNGs with memory and disk LRU tiers
+# ---------------------------------------------------------------------------
+PLOT_CACHE_MEMORY_BYTES = int(os.environ.get("PLOT_CACHE_MEMORY_BYTES", 32 * 1024 * 1024))
+PLOT_CACHE_DIR = os.environ.get("PLOT_CACHE_DIR")  # disk tier is disabled when unset
+PLOT_CACHE_DISK_BYTES = int(os.environ.get("PLOT_CACHE_DISK_BYTES", 256 * 1024 * 1024))
+PLOT_CACHE_MAX_FILE_IDS = 4096
+
+def plot_cache_key(scenario, single_point_coords):
+    # The marker position is drawn on the plot, so it is part of the key with the plot height.
+    scenario = compile_scenario(scenario)
+    canonical = json.dumps(
+        {'scenario': scenario.params,
+         'point': [float(single_point_coords[axis]) for axis in ('x', 'y', 'z')],
+         'renderer': PLOT_RENDERER, 'format': PLOT_FORMAT if PLOT_RENDERER == 'raster' else 'png',
+         'grid': PLOT_GRID},
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class PlotCache:
+    def __init__(self, memory_bytes, disk_dir=None, disk_bytes=0):
+        self.memory_bytes = memory_bytes
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        self.hits = 0
+        self.misses = 0
+        self._memory = collections.OrderedDict()
+        self._memory_used = 0
+        self._disk = collections.OrderedDict()  # key -> size, least recently used first
+        self._disk_used = 0
+        self._file_ids = collections.OrderedDict()
+        # get/put run in worker threads so disk I/O stays off the event loop.
+        self._lock = threading.Lock()
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            entries = []
+            for name in os.listdir(disk_dir):
+                if name.endswith('.png'):
+                    stat = os.stat(os.path.join(disk_dir, name))
+                    entries.append((stat.st_mtime, name[:-4], stat.st_size))
+            for _, key, size in sorted(entries):
+                self._disk[key] = size
+                self._disk_used += size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key + '.png')
+
+    def _remember(self, key, png):
+        if len(png) > self.memory_bytes: return
+        if key in self._memory:
+            self._memory_used -= len(self._memory.pop(key))
+        self._memory[key] = png
+        self._memory_used += len(png)
+        while self._memory_used > self.memory_bytes:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_used -= len(evicted)
+
+    def _log(self, outcome, key):
+        logger.info("Plot cache %s for %s (hits=%d, misses=%d)", outcome, key[:12], self.hits, self.misses)
+
+    def get(self, key):
+        with self._lock:
+            png = self._memory.get(key)
+            if png is not None:
+                self._memory.move_to_end(key)
+                self.hits += 1
+                self._log("memory hit", key)
+                return png
+            if key in self._disk:
+                try:
+                    with open(self._disk_path(key), 'rb') as f:
+                        png = f.read()
+                    os.utime(self._disk_path(key))
+                except OSError:
+                    self._disk_used -= self._disk.pop(key)
+                else:
+                    self._disk.move_to_end(key)
+                    self._remember(key, png)
+                    self.hits += 1
+                    self._log("disk hit", key)
+                    return png
+            self.misses += 1
+            self._log("miss", key)
+            return None
+
+    def put(self, key, png):
+        with self._lock:
+            self._remember(key, png)
+            if not self.disk_dir or len(png) > self.disk_bytes: return
+            tmp_path = self._disk_path(key) + '.tmp'
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, self._disk_path(key))
+            if key in self._disk:
+                self._disk_used -= self._disk.pop(key)
+            self._disk[key] = len(png)
+            self._disk_used += len(png)
+            while self._disk_used > self.disk_bytes:
+                evicted, size = self._disk.popitem(last=False)
+                self._disk_used -= size
+                try:
+                    os.remove(self._disk_path(evicted))
+                except OSError:
+                    pass
+
+    def get_file_id(self, key):
+        file_id = self._file_ids.get(key)
+        if file_id is not None:
+            self._file_ids.move_to_end(key)
+            self.hits += 1
+            self._log("file_id hit", key)
+        return file_id
+
+    def set_file_id(self, key, file_id):
+        self._file_ids[key] = file_id
+        self._file_ids.move_to_end(key)
+        while len(self._file_ids) > PLOT_CACHE_MAX_FILE_IDS:
+            self._file_ids.popitem(last=False)
+
+    def forget_file_id(self, key):
+        self._file_ids.pop(key, None)
+
+plot_cache = PlotCache(PLOT_CACHE_MEMORY_BYTES, PLOT_CACHE_DIR, PLOT_CACHE_DISK_BYTES)
+
+# ---------------------------------------------------------------------------
+# Persistence: conversation state, saved scenarios and results in SQL
+# ---------------------------------------------------------------------------
+DATABASE_URL = os.environ.get("DATABASE_URL", "sqlite:///bot_state.db")  # empty disables persistence
+DATABASE_POOL_SIZE = int(os.environ.get("DATABASE_POOL_SIZE", 5))
+PERSISTENCE_UPDATE_INTERVAL = float(os.environ.get("PERSISTENCE_UPDATE_INTERVAL", 10))
+RESULTS_MAX_ROWS = int(os.environ.get("RESULTS_MAX_ROWS", 10000))  # oldest stored point results are pruned beyond this
+
+def database_url(url):
+    # Heroku-style postgres:// URLs are no longer accepted by SQLAlchemy.
+    if url.startswith("postgres://"): url = "postgresql://" + url[len("postgres://"):]
+    return url
+
+def point_result_key(params, point):
+    canonical = json.dumps(
+        {'scenario': compile_scenario(params).params, 'point': [float(point[axis]) for axis in ('x', 'y', 'z')]},
+        sort_keys=True, separators=(',', ':')
+    )
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+def _as_tuples(value):
+    return tuple(_as_tuples(item) for item in value) if isinstance(value, list) else value
+
+def dump_point_result(terms, stages):
+    # JSON for the results table; NumPy scalars become plain numbers.
+    return json.dumps({
+        'terms': None if terms is None else terms._asdict(),
+        'stages': {name: [inputs, outputs] for name, (inputs, outputs) in stages.items()},
+    }, default=lambda value: value.item())
+
+def load_point_result(text):
+    # Inverse of dump_point_result; lists come back as tuples so stage inputs compare equal.
+    data = json.loads(text)
+    terms = None if data['terms'] is None else PlumeTerms(**{name: _as_tuples(value) for name, value in data['terms'].items()})
+    stages = {name: (_as_tuples(inputs), _as_tuples(outputs)) for name, (inputs, outputs) in data['stages'].items()}
+    return terms, stages
+
+class SQLPersistence(BasePersistence):
+    # Stores user_data and conversation states for python-telegram-bot. The saved scenario
+    # and receptor go to their own table; computed point results are kept by content key
+    # as JSON, the newest max_results of them. Updates are collected in memory and written
+    # in one transaction from a worker thread.
+    def __init__(self, url, pool_size=5, update_interval=60, max_results=10000):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False, user_data=True),
+            update_interval=update_interval,
+        )
+        import sqlalchemy as sa  # optional; only needed when persistence is enabled
+        self.sa = sa
+        url = database_url(url)
+        options = {'pool_pre_ping': True}
+        if not url.startswith('sqlite'): options.update(pool_size=pool_size, max_overflow=pool_size)
+        self.engine = sa.create_engine(url, **options)
+        metadata = sa.MetaData()
+        self.conversations_table = sa.Table(
+            'conversations', metadata,
+            sa.Column('name', sa.String(64), primary_key=True), sa.Column('key', sa.String(128), primary_key=True),
+            sa.Column('state', sa.Integer, nullable=False))
+        self.user_data_table = sa.Table(
+            'user_data', metadata,
+            sa.Column('user_id', sa.BigInteger, primary_key=True), sa.Column('data', sa.LargeBinary, nullable=False))
+        self.scenarios_table = sa.Table(
+            'scenarios', metadata,
+            sa.Column('user_id', sa.BigInteger, primary_key=True), sa.Column('params', sa.Text, nullable=False),
+            sa.Column('point', sa.Text), sa.Column('updated_at', sa.Float, nullable=False))
+        self.results_table = sa.Table(
+            'point_results', metadata,
+            sa.Column('key', sa.String(64), primary_key=True), sa.Column('result', sa.Text, nullable=False),
+            sa.Column('created_at', sa.Float, nullable=False, index=True))
+        metadata.create_all(self.engine)
+        self.max_results = max_results
+        # Pending writes; a None value deletes the row.
+        self._pending_users = {}
+        self._pending_conversations = {}
+        self._pending_results = {}
+        self._writer = None
+
+    # --- loading (once at startup, off the event loop) ---
+
+    def _load_user_data(self):
+        user_data = collections.defaultdict(dict)
+        with self.engine.connect() as conn:
+            for user_id, data in conn.execute(self.sa.select(self.user_data_table)):
+                user_data[user_id].update(pickle.loads(data))
+            for user_id, params, point, _ in conn.execute(self.sa.select(self.scenarios_table)):
+                user_data[user_id]['last_scenario'] = json.loads(params)
+                if point is not None: user_data[user_id]['last_point'] = json.loads(point)
+        return dict(user_data)
+
+    def _load_conversations(self, name):
+        table = self.conversations_table
+        with self.engine.connect() as conn:
+            rows = conn.execute(self.sa.select(table.c.key, table.c.state).where(table.c.name == name))
+            return {tuple(json.loads(key)): state for key, state in rows}
+
+    async def get_user_data(self):
+        return await asyncio.to_thread(self._load_user_data)
+
+    async def get_conversations(self, name):
+        return await asyncio.to_thread(self._load_conversations, name)
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    # --- updates (snapshotted on the loop, written in batches) ---
+
+    async def update_user_data(self, user_id, data):
+        scenario = {key: data[key] for key in ('last_scenario', 'last_point') if key in data}
+        rest = {key: value for key, value in data.items() if key not in scenario}
+        self._pending_users[user_id] = (pickle.dumps(rest), scenario)
+        self._schedule_write()
+
+    async def drop_user_data(self, user_id):
+        self._pending_users[user_id] = None
+        self._schedule_write()
+
+    async def update_conversation(self, name, key, new_state):
+        self._pending_conversations[(name, json.dumps(list(key)))] = new_state
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    # --- stored point results ---
+
+    def _load_result(self, key):
+        table = self.results_table
+        with self.engine.connect() as conn:
+            data = conn.execute(self.sa.select(table.c.result).where(table.c.key == key)).scalar()
+        return None if data is None else load_point_result(data)
+
+    async def get_result(self, key):
+        if key in self._pending_results: return load_point_result(self._pending_results[key])
+        return await asyncio.to_thread(self._load_result, key)
+
+    def put_result(self, key, terms, stages):
+        self._pending_results[key] = dump_point_result(terms, stages)
+        self._schedule_write()
+
+    # --- writing ---
+
+    def _schedule_write(self):
+        # Everything queued before the writer task gets to run goes into one transaction.
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.get_running_loop().create_task(self._write_pending())
+
+    def _take_pending(self):
+        batch = (self._pending_users, self._pending_conversations, self._pending_results)
+        self._pending_users, self._pending_conversations, self._pending_results = {}, {}, {}
+        return batch
+
+    async def _write_pending(self):
+        # Writes that arrive during a transaction are picked up by the next loop iteration.
+        await asyncio.sleep(0)
+        while self._pending_users or self._pending_conversations or self._pending_results:
+            try:
+                await asyncio.to_thread(self._write, *self._take_pending())
+            except Exception:
+                logger.exception("Writing persistent state failed")
+
+    def _write(self, users, conversations, results):
+        sa = self.sa
+        now = time.time()
+        with self.engine.begin() as conn:
+            if users:
+                user_ids = list(users)
+                conn.execute(sa.delete(self.user_data_table).where(self.user_data_table.c.user_id.in_(user_ids)))
+                conn.execute(sa.delete(self.scenarios_table).where(self.scenarios_table.c.user_id.in_(user_ids)))
+                rows = [(user_id, entry) for user_id, entry in users.items() if entry is not None]
+                if rows:
+                    conn.execute(sa.insert(self.user_data_table),
+                                 [{'user_id': user_id, 'data': data} for user_id, (data, _) in rows])
+                scenario_rows = [
+                    {'user_id': user_id, 'params': json.dumps(scenario['last_scenario']),
+                     'point': json.dumps(scenario['last_point']) if 'last_point' in scenario else None,
+                     'updated_at': now}
+                    for user_id, (_, scenario) in rows if 'last_scenario' in scenario
+                ]
+                if scenario_rows: conn.execute(sa.insert(self.scenarios_table), scenario_rows)
+            table = self.conversations_table
+            for (name, key), state in conversations.items():
+                conn.execute(sa.delete(table).where(table.c.name == name, table.c.key == key))
+            conversation_rows = [{'name': name, 'key': key, 'state': state}
+                                 for (name, key), state in conversations.items() if state is not None]
+            if conversation_rows: conn.execute(sa.insert(table), conversation_rows)
+            if results:
+                table = self.results_table
+                conn.execute(sa.delete(table).where(table.c.key.in_(list(results))))
+                conn.execute(sa.insert(table), [{'key': key, 'result': data, 'created_at': now}
+                                                for key, data in results.items()])
+                # Keep only the newest max_results rows.
+                stale = sa.select(table.c.key).order_by(table.c.created_at.desc()).offset(self.max_results)
+                conn.execute(sa.delete(table).where(table.c.key.in_(stale.scalar_subquery())))
+
+    async def flush(self):
+        if self._writer is not None: await self._writer
+        await asyncio.to_thread(self._write, *self._take_pending())
+        self.engine.dispose()
+
+def open_persistence():
+    if not DATABASE_URL: return None
+    try:
+        return SQLPersistence(DATABASE_URL, DATABASE_POOL_SIZE, PERSISTENCE_UPDATE_INTERVAL, RESULTS_MAX_ROWS)
+    except ImportError:
+        logger.warning("sqlalchemy is not installed; running without persistence")
+        return None
+
 # ---------------------------------------------------------------------------
 # Part 2: Telegram Bot Implementation (REFACTORED AND STABLE)
 # ---------------------------------------------------------------------------
 (GET_X, GET_Y, GET_Z, GET_Q, GET_U_REF, GET_Z_REF, GET_STABILITY, GET_AREA, GET_HM, 
  GET_DS, GET_HS, GET_TS, GET_TA, GET_VS_CHOICE, GET_VS, GET_QS, GET_HALF_LIFE) = range(17)
 
+# user_data entries that outlive a single /calculate conversation.
+SAVED_USER_DATA_KEYS = ('last_scenario', 'last_point', 'last_stages')
+
+def clear_conversation_data(context: ContextTypes.DEFAULT_TYPE) -> None:
+    for key in list(context.user_data):
+        if key not in SAVED_USER_DATA_KEYS:
+            del context.user_data[key]
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     welcome_message = (
         "به نام خدا\n"
@@ -285,7 +2022,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await update.message.reply_text(welcome_message)
 
 async def calculate_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
+    clear_conversation_data(context)
     await update.message.reply_text(
         "شروع فرآیند محاسبه. لطفاً ۱۵ پارامتر زیر را به ترتیب وارد کنید.\n"
         "برای لغو عملیات در هر مرحله، دستور /cancel را ارسال کنید.\n\n"
@@ -460,6 +2197,63 @@ async def get_qs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         await update.message.reply_text("ورودی نامعتبر است. لطفاً یک عدد برای دبی وارد کنید.")
         return GET_QS
 
+async def send_scenario_plot(update: Update, context: ContextTypes.DEFAULT_TYPE, scenario, single_point_coords) -> None:
+    # Serves the plot from the cache when possible: a known Telegram file_id skips the
+    # upload, cached PNG bytes skip the render, and only a full miss renders in the pool.
+    caption = "نمودار توزیع غلظت آلاینده."
+    if PLOT_RENDERER == 'raster':
+        # The raster image carries no axis text, so the extent goes in the caption.
+        x_points, y_points = plot_axes(compile_scenario(scenario), single_point_coords)
+        caption += (f"\nارتفاع {single_point_coords['z']} متر | x: {x_points[0]:.0f} تا {x_points[-1]:.0f} متر | "
+                    f"y: {y_points[0]:.0f} تا {y_points[-1]:.0f} متر | غلظت: μg/m³")
+    key = plot_cache_key(scenario, single_point_coords)
+    file_id = plot_cache.get_file_id(key)
+    if file_id is not None:
+        try:
+            with stage_timer('send'):
+                await context.bot.send_photo(chat_id=update.effective_chat.id, photo=file_id, caption=caption)
+            return
+        except BadRequest:
+            plot_cache.forget_file_id(key)
+    png = await asyncio.to_thread(plot_cache.get, key)
+    if png is None:
+        plot_buffer = await compute_executor.run(generate_plot_for_telegram, scenario, single_point_coords)
+        png = plot_buffer.getvalue()
+        await asyncio.to_thread(plot_cache.put, key, png)
+    with stage_timer('send'):
+        message = await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png, caption=caption)
+    if message.photo:
+        plot_cache.set_file_id(key, message.photo[-1].file_id)
+
+async def stored_point_terms(context: ContextTypes.DEFAULT_TYPE, params, point, stages=None):
+    # Same result as rerun_point_terms, served from the results table when this scenario
+    # and receptor have been computed before.
+    store = context.application.persistence
+    key = point_result_key(params, point)
+    if isinstance(store, SQLPersistence):
+        stored = await store.get_result(key)
+        if stored is not None: return (*stored, [])
+    terms, stages, recomputed = await compute_executor.run(rerun_point_terms, params, point, stages)
+    if isinstance(store, SQLPersistence): store.put_result(key, terms, stages)
+    return terms, stages, recomputed
+
+async def run_user_job(update: Update, func, *args, timeout=None):
+    # Runs func(*args) through the per-user job scheduler. Queue-full, server-busy and
+    # timeout replies are sent here; the caller just stops on JobAborted (/cancel answers
+    # for itself).
+    try:
+        return await job_scheduler.run(update.effective_user.id, func, *args, timeout=timeout)
+    except ComputeQueueFull:
+        await update.message.reply_text("سرور در حال حاضر مشغول است. لطفاً کمی بعد دوباره تلاش کنید.")
+        raise JobAborted() from None
+    except JobQueueFull:
+        await update.message.reply_text(
+            "کارهای قبلی شما هنوز در صف هستند. لطفاً تا پایان آن‌ها صبر کنید یا با /cancel لغو کنید.")
+        raise
+    except JobTimeout:
+        await update.message.reply_text("زمان مجاز این محاسبه به پایان رسید و متوقف شد.")
+        raise
+
 async def get_half_life_and_run(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     try:
         context.user_data['T_half_life'] = float(update.message.text)
@@ -467,9 +2261,22 @@ async def get_half_life_and_run(update: Update, context: ContextTypes.DEFAULT_TY
         await update.message.reply_text("ورودی نامعتبر است. لطفاً یک عدد برای نیمه عمر وارد کنید.")
         return GET_HALF_LIFE
 
+    # A persisted conversation can resume here without its inputs (e.g. after a restart).
+    if any(name not in context.user_data for name in ('x', 'y', 'z', *SCENARIO_PARAM_NAMES)):
+        await update.message.reply_text(
+            "اطلاعات این محاسبه در دسترس نیست. لطفاً محاسبه را دوباره با /calculate شروع کنید.",
+            reply_markup=ReplyKeyboardRemove())
+        clear_conversation_data(context)
+        return ConversationHandler.END
+
+    if compute_executor.is_full:
+        await update.message.reply_text("سرور در حال حاضر مشغول است. لطفاً چند لحظه بعد دوباره نیمه عمر را ارسال کنید.")
+        return GET_HALF_LIFE
+
     await update.message.reply_text("تمام ورودی‌ها دریافت شد. لطفاً برای انجام محاسبات صبر کنید...", reply_markup=ReplyKeyboardRemove())
     
-    single_point_coords = {'x': context.user_data.pop('x'), 'y': context.user_data.pop('y'), 'z': context.user_data.pop('z')}
+    # The inputs stay in user_data until the job finishes, so a restart mid-job can retry.
+    single_point_coords = {'x': context.user_data['x'], 'y': context.user_data['y'], 'z': context.user_data['z']}
     scenario_params = context.user_data
     
     # --- THIS IS THE FIX ---
@@ -477,69 +2284,616 @@ async def get_half_life_and_run(update: Update, context: ContextTypes.DEFAULT_TY
     scenario_params.pop('current_state', None)
     # --------------------
 
-    concentration, trace_report = calculate_concentration(
-        x_receptor=single_point_coords['x'], y_receptor=single_point_coords['y'], z_receptor=single_point_coords['z'],
-        **scenario_params
-    )
-    
-    await update.message.reply_text(f"📝 **گزارش گام به گام محاسبات:**\n\n`{trace_report}`", parse_mode='Markdown')
-    
-    await update.message.reply_text(
-        f"✅ **نتیجه نهایی**\n\n"
-        f"غلظت محاسبه شده در نقطه (x={single_point_coords['x']}, y={single_point_coords['y']}, z={single_point_coords['z']}) برابر است با:\n"
-        f"**{concentration:.4f} میکروگرم بر متر مکعب**"
-    , parse_mode='Markdown')
+    # Compiled once here and shipped to the workers for both the point and the grid.
+    scenario = compile_scenario(scenario_params)
 
-    await update.message.reply_text("در حال آماده‌سازی نمودار... این مرحله ممکن است کمی طول بکشد.")
-    plot_buffer = generate_plot_for_telegram(scenario_params, single_point_coords)
-    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=plot_buffer, caption="نمودار توزیع غلظت آلاینده.")
+    async def calculate_job():
+        terms, stages, _ = await stored_point_terms(context, scenario, single_point_coords)
+        concentration = 0.0 if terms is None else terms.C
+        
+        await update.message.reply_text(f"📝 **گزارش گام به گام محاسبات:**\n\n`{format_trace_report(terms)}`", parse_mode='Markdown')
+        
+        await update.message.reply_text(
+            f"✅ **نتیجه نهایی**\n\n"
+            f"غلظت محاسبه شده در نقطه (x={single_point_coords['x']}, y={single_point_coords['y']}, z={single_point_coords['z']}) برابر است با:\n"
+            f"**{concentration:.4f} میکروگرم بر متر مکعب**"
+        , parse_mode='Markdown')
+
+        await update.message.reply_text("در حال آماده‌سازی نمودار... این مرحله ممکن است کمی طول بکشد.")
+        await send_scenario_plot(update, context, scenario, single_point_coords)
+        return stages
+
+    try:
+        stages = await run_user_job(update, calculate_job)
+    except JobAborted:
+        clear_conversation_data(context)
+        return ConversationHandler.END
 
     await update.message.reply_text("محاسبه کامل شد! برای شروع یک محاسبه جدید، دستور /calculate را ارسال کنید.")
-    context.user_data.clear()
+    clear_conversation_data(context)
+    context.user_data['last_scenario'] = dict(scenario.params)
+    context.user_data['last_point'] = single_point_coords
+    context.user_data['last_stages'] = stages
     return ConversationHandler.END
 
+def parse_parameter_value(name, value):
+    if name == 'stability_class':
+        value = value.upper()
+        if value not in ['A', 'B', 'C', 'D', 'E', 'F']: raise ValueError(f"{name}={value}")
+        return value
+    if name == 'area_type':
+        value = value.lower()
+        if value not in ['urban', 'rural']: raise ValueError(f"{name}={value}")
+        return value
+    return float(value)
+
+def parse_key_values(text):
+    # "name=value name=value ..." as typed in a message; raises ValueError on bad tokens.
+    values = {}
+    for token in text.replace(',', ' ').split():
+        name, sep, value = token.partition('=')
+        if not sep or not name: raise ValueError(token)
+        values[name] = parse_parameter_value(name, value)
+    return values
+
+MULTISOURCE_USAGE = (
+    "فرمت دستور /multisource:\n"
+    "خط اول (هواشناسی مشترک):\n"
+    "/multisource u_ref=4 z_ref=10 stability_class=D area_type=rural Hm_boundary_layer=800 Ta_ambient_temp=290 wind_direction=270 z=0\n"
+    "هر خط بعدی یک دودکش:\n"
+    "x=0 y=0 Q_emission=100 ds_stack_diameter=2 hs_stack_height=50 Ts_stack_temp=420 vs_stack_velocity=12 T_half_life=0\n\n"
+    "x و y مختصات دودکش به متر (x به سمت شرق، y به سمت شمال) و wind_direction جهتی است که باد از آن می‌وزد (درجه از شمال)."
+)
+
+async def multisource(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    lines = [line for line in update.message.text.splitlines() if line.strip()]
+    lines[0] = lines[0].split(maxsplit=1)[1] if len(lines[0].split(maxsplit=1)) > 1 else ''
+    try:
+        met = parse_key_values(lines[0])
+        wind_direction = met.pop('wind_direction', 270.0)
+        z_receptor = met.pop('z', 0.0)
+        stacks = [parse_key_values(line) for line in lines[1:]]
+        if not stacks or set(met) != set(MET_PARAM_NAMES) or any(set(stack) != set(STACK_PARAM_NAMES) for stack in stacks):
+            raise ValueError("missing or unknown parameters")
+    except (ValueError, IndexError):
+        await update.message.reply_text(MULTISOURCE_USAGE)
+        return
+
+    await update.message.reply_text(f"در حال محاسبه غلظت مجموع {len(stacks)} دودکش...")
+    try:
+        png, c_max, x_max, y_max = await run_user_job(
+            update, compute_executor.run, generate_site_plot, met, stacks, wind_direction, z_receptor)
+    except JobAborted:
+        return
+    await context.bot.send_photo(
+        chat_id=update.effective_chat.id, photo=png,
+        caption=f"بیشینه غلظت روی شبکه: {c_max:.4f} μg/m³ در (x={x_max:.0f}, y={y_max:.0f}) متر"
+    )
+
+def saved_scenario_params(context: ContextTypes.DEFAULT_TYPE, overrides=None):
+    # The last completed /calculate scenario, optionally updated with name=value overrides;
+    # None when the result is still missing parameters.
+    params = dict(context.user_data.get('last_scenario', {}))
+    params.update(overrides or {})
+    if any(name not in params for name in SCENARIO_PARAM_NAMES): return None
+    return params
+
+async def bulk(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data['awaiting_upload'] = 'bulk'
+    await update.message.reply_text(
+        "لطفاً فایل CSV یا TSV گیرنده‌ها را با ستون‌های x, y, z (به متر) ارسال کنید.\n"
+        "سناریوی آخرین محاسبه (/calculate) استفاده می‌شود؛ برای تغییر پارامترها می‌توانید در توضیح (caption) فایل "
+        "مقادیری مانند u_ref=5 stability_class=C بنویسید."
+    )
+
+async def download_upload(update: Update, context: ContextTypes.DEFAULT_TYPE, path) -> None:
+    telegram_file = await context.bot.get_file(update.message.document.file_id)
+    await telegram_file.download_to_drive(path)
+
+async def receive_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    mode = context.user_data.pop('awaiting_upload', None)
+    jobs = {'bulk': run_bulk_upload, 'timeseries': run_timeseries_upload}
+    if mode not in jobs:
+        await update.message.reply_text("برای پردازش فایل ابتدا دستور /bulk یا /timeseries را ارسال کنید.")
+        return
+    try:
+        await run_user_job(update, jobs[mode], update, context, timeout=UPLOAD_JOB_TIMEOUT)
+    except JobAborted:
+        pass
+
+async def run_bulk_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        overrides = parse_key_values(update.message.caption or '')
+    except ValueError as e:
+        await update.message.reply_text(f"پارامتر نامعتبر در توضیح فایل: {e}")
+        return
+    params = saved_scenario_params(context, overrides)
+    if params is None:
+        await update.message.reply_text(
+            "سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید یا همه پارامترها را در توضیح فایل بنویسید."
+        )
+        return
+    scenario = compile_scenario(params)
+
+    with tempfile.TemporaryDirectory(prefix='bulk-') as workdir:
+        in_path = os.path.join(workdir, 'receptors.csv')
+        out_path = os.path.join(workdir, 'results.csv')
+        await download_upload(update, context, in_path)
+        try:
+            f, reader, header, columns = await asyncio.to_thread(open_receptor_csv, in_path)
+        except (ValueError, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"فایل قابل خواندن نیست: {e}")
+            return
+
+        status = await update.message.reply_text("پردازش فایل آغاز شد...")
+        processed = 0
+        last_report = time.monotonic()
+        with f, open(out_path, 'w', newline='', encoding='utf-8') as out:
+            writer = csv.writer(out)
+            writer.writerow(header + ['concentration_ug_m3'])
+            while True:
+                rows, coords = await asyncio.to_thread(read_receptor_chunk, reader, columns, BULK_CHUNK_ROWS)
+                if not rows: break
+                concentration = await compute_executor.run(evaluate_receptor_chunk, scenario, coords)
+                await asyncio.to_thread(write_result_chunk, writer, rows, concentration)
+                processed += len(rows)
+                if time.monotonic() - last_report > 3:
+                    last_report = time.monotonic()
+                    await status.edit_text(f"در حال پردازش... {processed:,} ردیف انجام شد.")
+
+        if os.path.getsize(out_path) > BULK_MAX_UPLOAD_BYTES:
+            out_path = await asyncio.to_thread(gzip_file, out_path)
+        await status.edit_text(f"پردازش کامل شد: {processed:,} ردیف.")
+        with open(out_path, 'rb') as result:
+            await update.message.reply_document(
+                document=result, filename=os.path.basename(out_path),
+                caption="غلظت هر گیرنده بر حسب میکروگرم بر متر مکعب."
+            )
+
+async def max_concentration(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        options = parse_key_values(' '.join(context.args))
+    except ValueError as e:
+        await update.message.reply_text(f"پارامتر نامعتبر: {e}")
+        return
+    z_receptor = options.pop('z', 0.0)
+    y_receptor = options.pop('y', 0.0)
+    params = saved_scenario_params(context, options)
+    if params is None:
+        await update.message.reply_text("سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید.")
+        return
+    x_at_max, c_max = find_max_concentration(params, z_receptor, y_receptor)
+    await update.message.reply_text(
+        f"📈 بیشینه غلظت در ارتفاع z={z_receptor} متر و فاصله عرضی y={y_receptor} متر:\n"
+        f"{c_max:.4f} میکروگرم بر متر مکعب در فاصله x={x_at_max:.1f} متر در راستای باد"
+    )
+
+async def timeseries(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    context.user_data['awaiting_upload'] = 'timeseries'
+    await update.message.reply_text(
+        "لطفاً فایل CSV داده‌های ساعتی هواشناسی را با ستون‌های u_ref, stability_class, Hm, Ta ارسال کنید.\n"
+        "مشخصات دودکش از آخرین محاسبه (/calculate) برداشته می‌شود. در توضیح (caption) فایل می‌توانید "
+        "z=0 (ارتفاع گیرنده‌ها)، top_n=8 (رتبه N-ام بیشترین مقدار ساعتی) و سایر پارامترها را تغییر دهید."
+    )
+
+async def run_timeseries_upload(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        overrides = parse_key_values(update.message.caption or '')
+    except ValueError as e:
+        await update.message.reply_text(f"پارامتر نامعتبر در توضیح فایل: {e}")
+        return
+    z_receptor = overrides.pop('z', 0.0)
+    top_n = max(1, int(overrides.pop('top_n', 8)))
+    # The hourly columns replace these, so placeholders are enough for a saved source.
+    params = saved_scenario_params(context, {'u_ref': 1.0, 'stability_class': 'D', 'Hm_boundary_layer': 1000.0,
+                                             'Ta_ambient_temp': 293.0, **overrides})
+    if params is None:
+        await update.message.reply_text("سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید.")
+        return
+
+    x_points, y_points = fixed_plot_axes()
+    X, Y = np.meshgrid(x_points, y_points)
+    x_receptor, y_receptor = X.ravel(), Y.ravel()
+    accumulator = LongTermAccumulator(x_receptor.size, top_n)
+    hours = skipped = distinct = 0
+
+    with tempfile.TemporaryDirectory(prefix='met-') as workdir:
+        in_path = os.path.join(workdir, 'met.csv')
+        out_path = os.path.join(workdir, 'long_term.csv')
+        await download_upload(update, context, in_path)
+        try:
+            f, reader, columns = await asyncio.to_thread(open_met_csv, in_path)
+        except (ValueError, UnicodeDecodeError) as e:
+            await update.message.reply_text(f"فایل قابل خواندن نیست: {e}")
+            return
+
+        status = await update.message.reply_text("پردازش داده‌های هواشناسی آغاز شد...")
+        last_report = time.monotonic()
+        # Pass 1 streams the file and counts hours per case; memory grows with distinct cases only.
+        case_hours = collections.Counter()
+        with f:
+            while True:
+                cases, rows, bad = await asyncio.to_thread(read_met_cases, reader, columns, MET_CHUNK_ROWS)
+                if not rows: break
+                skipped += bad
+                case_hours.update(cases)
+                if time.monotonic() - last_report > 3:
+                    last_report = time.monotonic()
+                    await status.edit_text(f"در حال خواندن فایل... {sum(case_hours.values()):,} ساعت خوانده شد.")
+        # Pass 2 evaluates each distinct case once, in stacked batches.
+        pending = sorted(case_hours, key=lambda case: case[1])
+        for start in range(0, len(pending), MET_CASE_BATCH):
+            batch = pending[start:start + MET_CASE_BATCH]
+            ordered, fields = await compute_executor.run(
+                evaluate_met_cases, params, batch, x_receptor, y_receptor, z_receptor
+            )
+            await asyncio.to_thread(accumulator.add_cases, ordered, fields, case_hours)
+            hours += sum(case_hours[case] for case in batch)
+            distinct += len(batch)
+            if time.monotonic() - last_report > 3:
+                last_report = time.monotonic()
+                await status.edit_text(f"در حال پردازش... {distinct:,} از {len(pending):,} حالت هواشناسی انجام شد.")
+        if hours == 0:
+            await status.edit_text("هیچ ردیف معتبری در فایل پیدا نشد.")
+            return
+
+        mean = accumulator.mean()
+        nth = accumulator.nth_highest()
+        await asyncio.to_thread(write_long_term_csv, out_path, x_receptor, y_receptor, accumulator)
+        png = await compute_executor.run(
+            render_long_term_plot, x_points, y_points, mean.reshape(X.shape),
+            f'میانگین بلندمدت غلظت در ارتفاع {z_receptor} متری ({hours} ساعت)'
+        )
+        i_mean = int(np.argmax(mean))
+        i_max = int(np.argmax(accumulator.maximum))
+        i_nth = int(np.nanargmax(nth)) if np.isfinite(nth).any() else 0
+        await status.edit_text(
+            f"✅ پردازش کامل شد: {hours:,} ساعت ({distinct:,} حالت هواشناسی محاسبه شد، {skipped:,} ردیف نامعتبر).\n"
+            f"بیشینه میانگین دوره: {mean[i_mean]:.4f} μg/m³ در (x={x_receptor[i_mean]:.0f}, y={y_receptor[i_mean]:.0f})\n"
+            f"بیشینه ساعتی: {accumulator.maximum[i_max]:.4f} μg/m³ در (x={x_receptor[i_max]:.0f}, y={y_receptor[i_max]:.0f})\n"
+            f"بیشینه رتبه {top_n}-ام ساعتی: {nth[i_nth]:.4f} μg/m³ در (x={x_receptor[i_nth]:.0f}, y={y_receptor[i_nth]:.0f})"
+        )
+        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png, caption="میانگین بلندمدت غلظت.")
+        with open(out_path, 'rb') as result:
+            await update.message.reply_document(document=result, filename='long_term.csv',
+                                                caption="آمار بلندمدت هر گیرنده (μg/m³).")
+
+SWEEP_USAGE = (
+    "فرمت دستور /sweep (یک یا دو پارامتر):\n"
+    "/sweep hs_stack_height=20:200:10\n"
+    "/sweep stability_class=all u_ref=2:8:4\n"
+    "بازه عددی به صورت شروع:پایان:تعداد یا مقادیر جدا شده با / نوشته می‌شود؛ "
+    "برای stability_class حروف (مثلاً ACF) یا all و برای area_type مقدار both.\n"
+    "سایر پارامترها از آخرین محاسبه (/calculate) برداشته می‌شوند."
+)
+
+async def sweep(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        sweeps = []
+        for token in context.args:
+            name, sep, text = token.partition('=')
+            if not sep: raise ValueError(token)
+            sweeps.append((name, parse_sweep_values(name, text)))
+        if not 1 <= len(sweeps) <= 2 or len({name for name, _ in sweeps}) != len(sweeps):
+            raise ValueError("one or two parameters")
+    except ValueError:
+        await update.message.reply_text(SWEEP_USAGE)
+        return
+    if np.prod([len(values) for _, values in sweeps]) > SWEEP_MAX_COMBINATIONS:
+        await update.message.reply_text(f"حداکثر {SWEEP_MAX_COMBINATIONS} ترکیب مجاز است.")
+        return
+    params = saved_scenario_params(context)
+    point = context.user_data.get('last_point')
+    if params is None or point is None:
+        await update.message.reply_text("سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید.")
+        return
+
+    async def sweep_job():
+        at_point, c_max, x_at_max = await compute_executor.run(evaluate_parameter_sweep, params, point, sweeps)
+        png = await compute_executor.run(render_sweep_chart, sweeps, at_point, c_max)
+        return at_point, c_max, x_at_max, png
+
+    try:
+        at_point, c_max, x_at_max, png = await run_user_job(update, sweep_job)
+    except JobAborted:
+        return
+    table = format_sweep_table(sweeps, at_point, c_max, x_at_max)
+    if len(table) > 3500:
+        table = table[:3500] + "\n..."
+    await update.message.reply_text(
+        f"📊 نتایج حساسیت (گیرنده x={point['x']}, y={point['y']}, z={point['z']}، غلظت بر حسب μg/m³):\n```\n{table}\n```",
+        parse_mode='Markdown'
+    )
+    await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png, caption="نمودار حساسیت.")
+
+SET_USAGE = (
+    "فرمت دستور /set:\n"
+    "/set Ts_stack_temp=450 y=100\n"
+    "پارامترهای سناریو یا مختصات نقطه (x, y, z) آخرین محاسبه تغییر می‌کنند و فقط مراحلی که به آن‌ها وابسته‌اند دوباره محاسبه می‌شوند."
+)
+
+async def set_parameters(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        overrides = parse_key_values(' '.join(context.args))
+        if not overrides or any(name not in SCENARIO_PARAM_NAMES and name not in ('x', 'y', 'z') for name in overrides):
+            raise ValueError("missing or unknown parameters")
+    except ValueError:
+        await update.message.reply_text(SET_USAGE)
+        return
+    previous_params = saved_scenario_params(context)
+    previous_point = context.user_data.get('last_point')
+    if previous_params is None or previous_point is None:
+        await update.message.reply_text("سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید.")
+        return
+    params = {**previous_params, **{name: value for name, value in overrides.items() if name in SCENARIO_PARAM_NAMES}}
+    point = {axis: overrides.get(axis, previous_point[axis]) for axis in ('x', 'y', 'z')}
+
+    async def set_job():
+        terms, stages, recomputed = await stored_point_terms(
+            context, params, point, context.user_data.get('last_stages'))
+        context.user_data['last_scenario'] = params
+        context.user_data['last_point'] = point
+        context.user_data['last_stages'] = stages
+        concentration = 0.0 if terms is None else terms.C
+
+        await update.message.reply_text(f"📝 **گزارش گام به گام محاسبات:**\n\n`{format_trace_report(terms)}`", parse_mode='Markdown')
+        await update.message.reply_text(
+            f"✅ غلظت در نقطه (x={point['x']}, y={point['y']}, z={point['z']}): **{concentration:.4f} میکروگرم بر متر مکعب**\n"
+            f"مراحل محاسبه شده مجدد: {', '.join(f'`{name}`' for name in recomputed) if recomputed else 'هیچ'}",
+            parse_mode='Markdown'
+        )
+        if plot_cache_key(params, point) == plot_cache_key(previous_params, previous_point):
+            await update.message.reply_text("ورودی‌های نمودار تغییری نکرده‌اند؛ نمودار قبلی همچنان معتبر است.")
+            return
+        await send_scenario_plot(update, context, params, point)
+
+    try:
+        await run_user_job(update, set_job)
+    except JobAborted:
+        pass
+
+VOLUME_USAGE = (
+    "فرمت دستور /volume:\n"
+    "/volume z=0/1.5/10/30 export=1 nz=40 ny=200 nx=200\n"
+    "z ارتفاع‌های نمایش (به متر، جدا شده با /) است؛ با export=1 کل شبکه سه‌بعدی به صورت فایل .npy "
+    "(ابعاد nz×ny×nx) همراه با محورها در فایل .npz ارسال می‌شود. سناریو و نقطه از آخرین محاسبه برداشته می‌شوند."
+)
+
+async def volume(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    try:
+        options = dict(token.split('=', 1) for token in context.args)
+        heights = [float(value) for value in options.pop('z', '/'.join(f"{z:g}" for z in VOLUME_HEIGHTS)).split('/')]
+        export = options.pop('export', '0') not in ('0', 'no', 'false')
+        shape = tuple(int(options.pop(name, default)) for name, default in zip(('nz', 'ny', 'nx'), VOLUME_EXPORT_SHAPE))
+        if options or not 1 <= len(heights) <= 8 or min(shape) < 2: raise ValueError(options)
+    except ValueError:
+        await update.message.reply_text(VOLUME_USAGE)
+        return
+    if export and np.prod(shape) > VOLUME_MAX_ELEMENTS:
+        await update.message.reply_text(f"حداکثر {VOLUME_MAX_ELEMENTS:,} نقطه برای خروجی سه‌بعدی مجاز است.")
+        return
+    params = saved_scenario_params(context)
+    point = context.user_data.get('last_point')
+    if params is None or point is None:
+        await update.message.reply_text("سناریویی ذخیره نشده است. ابتدا یک محاسبه با /calculate انجام دهید.")
+        return
+
+    async def volume_job():
+        png = await compute_executor.run(render_volume_plot, params, point, heights)
+        await context.bot.send_photo(chat_id=update.effective_chat.id, photo=png,
+                                     caption="غلظت در چند ارتفاع و مقطع قائم در امتداد محور دود.")
+        if not export: return
+        with tempfile.TemporaryDirectory(prefix='volume-') as workdir:
+            volume_path, axes_path = await compute_executor.run(export_volume, params, point, shape, workdir)
+            if os.path.getsize(volume_path) > TELEGRAM_MAX_DOCUMENT_BYTES:
+                await update.message.reply_text("فایل خروجی برای ارسال در تلگرام بزرگ است؛ ابعاد کوچک‌تری انتخاب کنید.")
+                return
+            with open(volume_path, 'rb') as f:
+                await update.message.reply_document(
+                    document=f, filename=os.path.basename(volume_path),
+                    caption=f"غلظت (μg/m³، float32) با ابعاد (z, y, x) = {shape}")
+            with open(axes_path, 'rb') as f:
+                await update.message.reply_document(document=f, filename='volume_axes.npz',
+                                                    caption="محورهای x, y, z به متر.")
+
+    await update.message.reply_text("در حال محاسبه غلظت در چند ارتفاع...")
+    try:
+        await run_user_job(update, volume_job, timeout=UPLOAD_JOB_TIMEOUT if export else None)
+    except JobAborted:
+        pass
+
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    context.user_data.clear()
-    await update.message.reply_text("عملیات لغو شد.", reply_markup=ReplyKeyboardRemove())
+    # Also registered outside the conversation, so running /sweep, /bulk, ... jobs can be stopped.
+    clear_conversation_data(context)
+    cancelled = job_scheduler.cancel(update.effective_user.id)
+    message = "عملیات لغو شد." if not cancelled else f"عملیات لغو شد ({cancelled} محاسبه در حال اجرا یا در صف متوقف شد)."
+    await update.message.reply_text(message, reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
+# ---------------------------------------------------------------------------
+# Webhook Serving: Flask endpoint feeding the update queue, per-chat ordering
+# ---------------------------------------------------------------------------
+BOT_MODE = os.environ.get("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.environ.get("WEBHOOK_URL")  # public base URL; setWebhook is skipped when unset
+WEBHOOK_PATH = os.environ.get("WEBHOOK_PATH", "/telegram")
+WEBHOOK_HOST = os.environ.get("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.environ.get("WEBHOOK_PORT", os.environ.get("PORT", 8080)))
+WEBHOOK_SECRET = os.environ.get("WEBHOOK_SECRET")
+UPDATE_CONCURRENCY = int(os.environ.get("UPDATE_CONCURRENCY", 32))
+TELEGRAM_API_BASE_URL = os.environ.get("TELEGRAM_API_BASE_URL")  # e.g. a local Bot API server or the replay stub
+UNBOUNDED_UPDATES = 2**31 - 1  # base-class limit for ChatOrderedUpdateProcessor
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    # Up to max_concurrent_updates run at once, but updates of the same chat run one at a
+    # time in arrival order, so ConversationHandler states advance exactly as in polling.
+    # The base class takes its semaphore before do_process_update, so it is given a limit
+    # that never binds; the real slot is taken after the chat's lock, so updates queued
+    # behind their own chat hold no slot and one busy chat cannot stall the others.
+    def __init__(self, max_concurrent_updates):
+        super().__init__(UNBOUNDED_UPDATES)
+        self._slots = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._chat_locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            async with self._slots:
+                await coroutine
+            return
+        entry = self._chat_locks.get(chat.id)
+        if entry is None:
+            entry = self._chat_locks[chat.id] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0], self._slots:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0: del self._chat_locks[chat.id]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def create_webhook_app(application, loop):
+    from flask import Flask, abort, request  # optional; only needed in webhook mode
+
+    app = Flask(__name__)
+
+    @app.post(WEBHOOK_PATH)
+    def telegram_webhook():
+        if WEBHOOK_SECRET and request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            abort(403)
+        update = Update.de_json(request.get_json(force=True), application.bot)
+        asyncio.run_coroutine_threadsafe(application.update_queue.put(update), loop).result()
+        return ""
+
+    @app.get("/healthz")
+    def healthz():
+        return "ok"
+
+    @app.get("/metrics")
+    def prometheus_metrics():
+        return metrics.render_prometheus(), 200, {'Content-Type': 'text/plain; version=0.0.4'}
+
+    return app
+
+async def serve_webhook(application):
+    # Mirrors run_polling's lifecycle, with a threaded werkzeug server in place of getUpdates.
+    from werkzeug.serving import make_server
+
+    server = make_server(WEBHOOK_HOST, WEBHOOK_PORT, create_webhook_app(application, asyncio.get_running_loop()),
+                         threaded=True)
+    server_thread = threading.Thread(target=server.serve_forever, name="webhook", daemon=True)
+    await application.initialize()
+    if application.post_init: await application.post_init(application)
+    try:
+        await application.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                allowed_updates=Update.ALL_TYPES)
+        server_thread.start()
+        logger.info("Serving webhook on %s:%d%s with %d concurrent updates",
+                    WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, UPDATE_CONCURRENCY)
+        await asyncio.Event().wait()
+    finally:
+        # shutdown() waits for serve_forever, so it would hang if start-up failed before it ran.
+        if server_thread.is_alive(): server.shutdown()
+        server.server_close()
+        if application.running: await application.stop()
+        await application.shutdown()
+        if application.post_shutdown: await application.post_shutdown(application)
+
 def main() -> None:
     TOKEN = os.environ.get("TELEGRAM_TOKEN")
     if not TOKEN:
         print("Error: TELEGRAM_TOKEN not found in Replit Secrets.")
         return
 
-    application = Application.builder().token(TOKEN).build()
+    background_tasks = []
+
+    async def warm_up(application: Application) -> None:
+        logger.info("Startup took %.3f s before serving updates", time.perf_counter() - _MODULE_LOAD_STARTED)
+        if PLOT_PREWARM:
+            # Runs in the background; polling starts without waiting for it.
+            background_tasks.append(asyncio.create_task(compute_executor.prewarm(), name="prewarm_renderer"))
+        if METRICS_LOG_INTERVAL > 0:
+            background_tasks.append(asyncio.create_task(log_metrics_periodically(METRICS_LOG_INTERVAL)))
+
+    async def shutdown_compute(application: Application) -> None:
+        for task in background_tasks:
+            task.cancel()
+        compute_executor.shutdown()
+
+    metrics.gauge('bot_compute_in_flight', lambda: compute_executor.in_flight)
+    metrics.gauge('bot_compute_queue_depth', lambda: compute_executor.queue_depth)
+    metrics.gauge('bot_jobs_running', lambda: job_scheduler.running)
+    metrics.gauge('bot_jobs_queued', lambda: job_scheduler.queued)
+    metrics.gauge('bot_plot_cache_hits_total', lambda: plot_cache.hits, 'counter')
+    metrics.gauge('bot_plot_cache_misses_total', lambda: plot_cache.misses, 'counter')
+    if BOT_MODE != 'webhook' and METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+
+    builder = Application.builder().token(TOKEN).post_init(warm_up).post_shutdown(shutdown_compute)
+    if TELEGRAM_API_BASE_URL:
+        builder = builder.base_url(TELEGRAM_API_BASE_URL)
+    if BOT_MODE == 'webhook':
+        builder = builder.concurrent_updates(ChatOrderedUpdateProcessor(UPDATE_CONCURRENCY))
+    persistence = open_persistence()
+    if persistence is not None:
+        builder = builder.persistence(persistence)
+    application = builder.build()
 
     conv_handler = ConversationHandler(
-        entry_points=[CommandHandler("calculate", calculate_start)],
+        entry_points=[CommandHandler("calculate", timed_handler(calculate_start))],
         states={
-            GET_X: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_x)],
-            GET_Y: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_y)],
-            GET_Z: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_z)],
-            GET_Q: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_q)],
-            GET_U_REF: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_u_ref)],
-            GET_Z_REF: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_z_ref)],
-            GET_STABILITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_stability)],
-            GET_AREA: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_area)],
-            GET_HM: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_hm)],
-            GET_DS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_ds)],
-            GET_HS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_hs)],
-            GET_TS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_ts)],
-            GET_TA: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_ta)],
-            GET_VS_CHOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_vs_choice)],
-            GET_VS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_vs)],
-            GET_QS: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_qs)],
-            GET_HALF_LIFE: [MessageHandler(filters.TEXT & ~filters.COMMAND, get_half_life_and_run)],
+            GET_X: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_x))],
+            GET_Y: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_y))],
+            GET_Z: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_z))],
+            GET_Q: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_q))],
+            GET_U_REF: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_u_ref))],
+            GET_Z_REF: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_z_ref))],
+            GET_STABILITY: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_stability))],
+            GET_AREA: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_area))],
+            GET_HM: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_hm))],
+            GET_DS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_ds))],
+            GET_HS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_hs))],
+            GET_TS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_ts))],
+            GET_TA: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_ta))],
+            GET_VS_CHOICE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_vs_choice))],
+            GET_VS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_vs))],
+            GET_QS: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_qs))],
+            # Non-blocking so other chats keep being served while this one awaits the compute pool.
+            GET_HALF_LIFE: [MessageHandler(filters.TEXT & ~filters.COMMAND, timed_handler(get_half_life_and_run), block=False)],
         },
-        fallbacks=[CommandHandler("cancel", cancel)],
+        fallbacks=[CommandHandler("cancel", timed_handler(cancel))],
+        name="calculate",
+        persistent=persistence is not None,
     )
 
-    application.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", timed_handler(start)))
+    application.add_handler(CommandHandler("multisource", timed_handler(multisource), block=False))
+    application.add_handler(CommandHandler("bulk", timed_handler(bulk)))
+    application.add_handler(CommandHandler("maxconc", timed_handler(max_concentration)))
+    application.add_handler(CommandHandler("timeseries", timed_handler(timeseries)))
+    application.add_handler(CommandHandler("sweep", timed_handler(sweep), block=False))
+    application.add_handler(CommandHandler("set", timed_handler(set_parameters), block=False))
+    application.add_handler(CommandHandler("volume", timed_handler(volume), block=False))
+    application.add_handler(MessageHandler(filters.Document.ALL, timed_handler(receive_document), block=False))
     application.add_handler(conv_handler)
+    application.add_handler(CommandHandler("cancel", timed_handler(cancel)))
     
     print("Bot is running...")
-    application.run_polling()
+    if BOT_MODE == 'webhook':
+        try:
+            asyncio.run(serve_webhook(application))
+        except KeyboardInterrupt:
+            pass
+    else:
+        application.run_polling()
 
 if __name__ == "__main__":
     main()
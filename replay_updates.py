@@ -0,0 +1,166 @@
+import argparse
+import collections
+import concurrent.futures
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# ---------------------------------------------------------------------------
+# Local replay stub: posts recorded updates to the bot's webhook and answers its
+# Bot API calls, so webhook throughput can be measured without Telegram.
+#
+#   python replay_updates.py --chats 50                 # synthetic /calculate sessions
+#   python replay_updates.py --updates recorded.jsonl   # one Update JSON per line
+# ---------------------------------------------------------------------------
+STUB_TOKEN = "123456:replay-stub"
+
+# One full /calculate conversation, in the order the bot asks for the inputs.
+CALCULATE_FLOW = [
+    "/calculate", "2000", "50", "1.5", "100", "4", "10", "D", "rural", "800",
+    "2", "50", "420", "290", "vs", "12", "0",
+]
+
+class BotApiStub:
+    # Minimal Bot API: every method succeeds and returns a plausible Message.
+    def __init__(self, port):
+        self.calls = collections.Counter()
+        self.last_call = None
+        self.lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                method = self.path.rsplit('/', 1)[-1]
+                with stub.lock:
+                    stub.calls[method] += 1
+                    stub.last_call = time.perf_counter()
+                body = json.dumps({'ok': True, 'result': stub.result(method)}).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def result(method):
+        if method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+        if method in ('setWebhook', 'deleteWebhook'):
+            return True
+        message = {'message_id': 1, 'date': int(time.time()), 'chat': {'id': 1, 'type': 'private'}}
+        if method == 'sendPhoto':
+            message['photo'] = [{'file_id': 'stub', 'file_unique_id': 'stub', 'width': 1, 'height': 1}]
+        return message
+
+def synthetic_updates(chats):
+    update_id = 0
+    for step, text in enumerate(CALCULATE_FLOW):
+        for chat_id in range(1, chats + 1):
+            update_id += 1
+            message = {
+                'message_id': step + 1, 'date': int(time.time()), 'text': text,
+                'chat': {'id': chat_id, 'type': 'private'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': f'user{chat_id}'},
+            }
+            if text.startswith('/'):
+                message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+            yield {'update_id': update_id, 'message': message}
+
+def chat_of(update):
+    for kind in ('message', 'edited_message', 'callback_query'):
+        if kind in update:
+            payload = update[kind]
+            return (payload.get('chat') or payload.get('message', {}).get('chat') or payload.get('from', {})).get('id')
+    return None
+
+def post(url, payload, secret):
+    request = urllib.request.Request(url, data=json.dumps(payload).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json'})
+    if secret: request.add_header('X-Telegram-Bot-Api-Secret-Token', secret)
+    with urllib.request.urlopen(request) as response:
+        response.read()
+
+def wait_until_up(url, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(url) as response:
+                if response.status == 200: return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"bot did not come up at {url}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay Telegram updates against the webhook mode")
+    parser.add_argument('--updates', help="JSON lines file of recorded Update payloads")
+    parser.add_argument('--chats', type=int, default=20, help="synthetic /calculate sessions when --updates is not given")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent posting threads (each chat stays in order)")
+    parser.add_argument('--api-port', type=int, default=8081)
+    parser.add_argument('--webhook-port', type=int, default=8080)
+    parser.add_argument('--concurrency', type=int, default=32, help="UPDATE_CONCURRENCY for the launched bot")
+    parser.add_argument('--idle', type=float, default=2.0, help="seconds without Bot API calls that end the run")
+    parser.add_argument('--url', help="post to an already running bot instead of launching main.py")
+    parser.add_argument('--secret', default=os.environ.get('WEBHOOK_SECRET'))
+    args = parser.parse_args()
+
+    if args.updates:
+        with open(args.updates, encoding='utf-8') as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = list(synthetic_updates(args.chats))
+    by_chat = collections.defaultdict(list)
+    for update in updates:
+        by_chat[chat_of(update)].append(update)
+
+    api = BotApiStub(args.api_port)
+    bot = None
+    url = args.url
+    if url is None:
+        env = dict(os.environ, BOT_MODE='webhook', TELEGRAM_TOKEN=STUB_TOKEN, WEBHOOK_URL='',
+                   WEBHOOK_HOST='127.0.0.1', WEBHOOK_PORT=str(args.webhook_port),
+                   UPDATE_CONCURRENCY=str(args.concurrency),
+                   TELEGRAM_API_BASE_URL=f"http://127.0.0.1:{args.api_port}/bot")
+        env.setdefault('DATABASE_URL', '')
+        bot = subprocess.Popen([sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')],
+                               env=env)
+        url = f"http://127.0.0.1:{args.webhook_port}{env.get('WEBHOOK_PATH', '/telegram')}"
+        wait_until_up(f"http://127.0.0.1:{args.webhook_port}/healthz", 60)
+
+    try:
+        started = time.perf_counter()
+        with concurrent.futures.ThreadPoolExecutor(args.clients) as pool:
+            list(pool.map(lambda chat_updates: [post(url, u, args.secret) for u in chat_updates], by_chat.values()))
+        posted = time.perf_counter()
+        while time.perf_counter() - (api.last_call or posted) < args.idle:
+            time.sleep(0.1)
+        finished = api.last_call or posted
+    finally:
+        if bot is not None:
+            bot.send_signal(signal.SIGINT)
+            bot.wait(30)
+        api.server.shutdown()
+
+    print(json.dumps({
+        'updates': len(updates), 'chats': len(by_chat),
+        'post_seconds': round(posted - started, 3),
+        'accepted_per_second': round(len(updates) / (posted - started), 1),
+        'end_to_end_seconds': round(finished - started, 3),
+        'processed_per_second': round(len(updates) / (finished - started), 1),
+        'api_calls': dict(api.calls),
+    }, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,159 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+# Regression checks for the compute executor, job scheduler, webhook update processor and
+# persistence writer. Thread workers keep them fast and free of process start-up.
+#
+#   python -m pytest -q tests
+
+def blocked_work(release):
+    # Ignores cancellation, like a render call: the worker is busy until `release` is set.
+    release.wait(10)
+    return 'done'
+
+def cooperative_work(seconds):
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        main.check_compute_cancelled()
+        time.sleep(0.005)
+    return 'done'
+
+def make_scheduler(monkeypatch, workers=2, slots=2):
+    executor = main.ComputeExecutor('thread', workers, 4)
+    monkeypatch.setattr(main, 'compute_executor', executor)
+    return executor, main.JobScheduler(slots, 2, 60)
+
+async def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        await asyncio.sleep(0.01)
+
+def test_cancel_holds_slot_until_worker_stops(monkeypatch):
+    async def scenario():
+        executor, scheduler = make_scheduler(monkeypatch)
+        release = threading.Event()
+        job = asyncio.create_task(scheduler.run(1, executor.run, blocked_work, release))
+        await wait_until(lambda: executor.in_flight == 1)
+        assert scheduler.cancel(1) == 1
+        with pytest.raises(main.JobCancelled):
+            await job
+        # The worker is still busy, so neither slot may be handed out yet.
+        await asyncio.sleep(0.05)
+        assert executor.in_flight == 1 and scheduler.running == 1
+        release.set()
+        await wait_until(lambda: executor.in_flight == 0 and scheduler.running == 0)
+        executor.shutdown()
+    asyncio.run(scenario())
+
+def test_cancel_stops_cooperative_work(monkeypatch):
+    async def scenario():
+        executor, scheduler = make_scheduler(monkeypatch)
+        job = asyncio.create_task(scheduler.run(1, executor.run, cooperative_work, 30))
+        await wait_until(lambda: executor.in_flight == 1)
+        scheduler.cancel(1)
+        with pytest.raises(main.JobCancelled):
+            await job
+        await wait_until(lambda: executor.in_flight == 0 and scheduler.running == 0, timeout=1.0)
+        executor.shutdown()
+    asyncio.run(scenario())
+
+def test_timeout_holds_slot_until_worker_stops(monkeypatch):
+    async def scenario():
+        executor, scheduler = make_scheduler(monkeypatch)
+        release = threading.Event()
+        with pytest.raises(main.JobTimeout):
+            await scheduler.run(1, executor.run, blocked_work, release, timeout=0.1)
+        assert executor.in_flight == 1 and scheduler.running == 1
+        release.set()
+        await wait_until(lambda: executor.in_flight == 0 and scheduler.running == 0)
+        executor.shutdown()
+    asyncio.run(scenario())
+
+def test_abandoned_work_counts_against_queue_limit(monkeypatch):
+    async def scenario():
+        executor, scheduler = make_scheduler(monkeypatch, workers=1, slots=4)
+        executor.queue_limit = 0
+        release = threading.Event()
+        job = asyncio.create_task(scheduler.run(1, executor.run, blocked_work, release))
+        await wait_until(lambda: executor.in_flight == 1)
+        scheduler.cancel(1)
+        with pytest.raises(main.JobCancelled):
+            await job
+        assert executor.is_full
+        with pytest.raises(main.ComputeQueueFull):
+            await scheduler.run(2, executor.run, cooperative_work, 0)
+        release.set()
+        await wait_until(lambda: not executor.is_full)
+        assert await scheduler.run(2, executor.run, cooperative_work, 0) == 'done'
+        executor.shutdown()
+    asyncio.run(scenario())
+
+def test_waiting_users_take_turns():
+    async def scenario():
+        scheduler = main.JobScheduler(1, 3, 60)
+        started = []
+
+        async def job(name):
+            started.append(name)
+            await asyncio.sleep(0.01)
+
+        jobs = [scheduler.run('A', job, 'A1'), scheduler.run('A', job, 'A2'), scheduler.run('A', job, 'A3'),
+                scheduler.run('B', job, 'B1'), scheduler.run('B', job, 'B2')]
+        await asyncio.gather(*jobs)
+        assert started == ['A1', 'B1', 'A2', 'B2', 'A3']
+    asyncio.run(scenario())
+
+def test_busy_chat_holds_no_update_slots():
+    async def scenario():
+        processor = main.ChatOrderedUpdateProcessor(2)
+        finished = []
+
+        async def handle(chat, index, seconds):
+            await asyncio.sleep(seconds)
+            finished.append((chat, index))
+
+        def update(chat):
+            return types.SimpleNamespace(effective_chat=types.SimpleNamespace(id=chat))
+
+        backlog = [asyncio.create_task(processor.process_update(update(1), handle(1, i, 0.05))) for i in range(5)]
+        await asyncio.sleep(0)
+        await processor.process_update(update(2), handle(2, 0, 0))
+        assert finished == [(2, 0)]
+        await asyncio.gather(*backlog)
+        assert [index for chat, index in finished if chat == 1] == list(range(5))
+    asyncio.run(scenario())
+
+def test_updates_during_a_write_are_persisted(tmp_path):
+    pytest.importorskip('sqlalchemy')
+    url = f"sqlite:///{tmp_path / 'state.db'}"
+
+    async def scenario():
+        persistence = main.SQLPersistence(url)
+        write = persistence._write
+
+        def slow_write(*batch):
+            time.sleep(0.2)
+            write(*batch)
+
+        persistence._write = slow_write
+        await persistence.update_user_data(1, {'a': 1})
+        await asyncio.sleep(0.05)  # the first transaction is now running
+        await persistence.update_user_data(2, {'b': 2})
+        await persistence.update_conversation('calculate', (2, 2), 5)
+        await wait_until(lambda: persistence._writer.done())
+        assert not persistence._pending_users and not persistence._pending_conversations
+
+        reopened = main.SQLPersistence(url)
+        assert await reopened.get_user_data() == {1: {'a': 1}, 2: {'b': 2}}
+        assert await reopened.get_conversations('calculate') == {(2, 2): 5}
+    asyncio.run(scenario())